@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import os
+import queue
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from opcua import Server
+from opcua import ua
+import opcPlugin
+
+# Benchmark of the OPC/UA plugin -> local OPC/UA server with synthetic tags, loopback MQTT broker and stubbed SNMP.
+# Every tag count runs in its own process, so CPU and RSS are measured for the plugin only.
+#
+# Examples:
+#   python3 benchmark.py --tags 10,100,1000 --duration 20 --save baseline.json
+#   python3 benchmark.py --tags 10,100,1000 --duration 20 --mode batch --compare baseline.json
+
+# OPC/UA server with synthetic tags changing at a configurable rate
+class SyntheticServer:
+    def __init__(self, port, tags, change_rate):
+        self.server = Server()
+        self.server.set_endpoint("opc.tcp://127.0.0.1:" + str(port))
+        self.namespace = self.server.register_namespace("urn:benchmark")
+        plc = self.server.get_objects_node().add_object(self.namespace, "PLC")
+        self.nodes = []
+        for index in range(tags):
+            self.nodes.append(plc.add_variable(ua.NodeId("T" + str(index), self.namespace), "T" + str(index), 0.0))
+        self.change_rate = float(change_rate)
+        self.running = False
+        self.updater = None
+
+    # Change all tag values periodically
+    def update(self):
+        step = 0
+        while self.running:
+            step += 1
+            for index, node in enumerate(self.nodes):
+                node.set_value(float((step + index) % 100))
+            time.sleep(1/self.change_rate)
+
+    def start(self):
+        self.server.start()
+        if self.change_rate > 0:
+            self.running = True
+            self.updater = threading.Thread(target=self.update, daemon=True)
+            self.updater.start()
+
+    def stop(self):
+        self.running = False
+        self.server.stop()
+
+# Loopback MQTT broker in place of the paho client -> delivers messages to a local subscriber thread
+class LoopbackBroker:
+    def __init__(self):
+        self.messages = queue.Queue()
+        self.latency = []
+        self.received = 0
+        self.bytes = 0
+        self.mid = 0
+        self.running = True
+        self.subscriber = threading.Thread(target=self.deliver, daemon=True)
+        self.subscriber.start()
+
+    # Receive messages and measure publish to receive latency from the payload timestamp
+    def deliver(self):
+        while self.running:
+            try:
+                topic, payload = self.messages.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.received += 1
+            self.bytes += len(payload)
+            try:
+                timestamp = json.loads(payload)["timestamp"]
+                self.latency.append(time.time()*1000 - timestamp)
+            except (ValueError, KeyError, TypeError):
+                pass
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.mid += 1
+        self.messages.put((topic, payload))
+        return createMessageInfo(self.mid)
+
+    def connect_async(self, host, port, keepalive):
+        pass
+
+    def disconnect(self):
+        self.running = False
+
+    def subscribe(self, topic):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def max_inflight_messages_set(self, inflight):
+        pass
+
+# Result of the loopback publish
+def createMessageInfo(mid):
+    info = opcPlugin.mqtt.MQTTMessageInfo(mid)
+    info.rc = opcPlugin.mqtt.MQTT_ERR_SUCCESS
+    return info
+
+# SNMP client stub -> no gateway is available on the benchmark host
+class StubSnmpClient:
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def getPosition(self):
+        return 50.0754072, 14.4165971
+
+# Percentiles of a list of values
+def percentiles(values):
+    if len(values) == 0:
+        return {"p50": None, "p95": None, "p99": None}
+    values = sorted(values)
+    return {name: round(values[min(int(len(values)*rank), len(values) - 1)], 3)
+            for name, rank in (("p50",0.5),("p95",0.95),("p99",0.99))}
+
+# Generate configuration file of the plugin
+def writeConfig(path, args, port, namespace, tags):
+    lines = ["[general]",
+             "polling=" + str(args.polling),
+             "polling_change=" + str(args.polling),
+             "mqtt_broker=127.0.0.1",
+             "mqtt_port=1883",
+             "opc_server=opc.tcp://@127.0.0.1:" + str(port),
+             "gw_ip=127.0.0.1",
+             "community=public",
+             "topic_name=benchmark/",
+             "debug=False",
+             "log_file=benchmark.log",
+             "persistency=False",
+             "history_length=10",
+             "mode=" + args.mode,
+             "publish_mode=" + args.publish_mode,
+             "encoding=json",
+             "",
+             "[variables]"]
+    for index in range(tags):
+        lines.append("t" + str(index) + "=ns=" + str(namespace) + ";s=T" + str(index))
+    with open(path, "w") as config_file:
+        config_file.write("\n".join(lines) + "\n")
+
+# Run the plugin against a running server and print results as JSON
+def runChild(args):
+    logging.basicConfig(level=logging.ERROR)
+    params = opcPlugin.Config(args.config)
+    general = params.getGeneral()
+    # No node cache -> every run starts cold and nothing is written to /data of the host
+    opc_client = opcPlugin.OpcClient(general["opc_server"],params.getOpcVariables(),params.getOpcVariablesSettings(),
+                                     general["persistency"],general["history_length"],general["mode"],cache_path=None)
+    mqtt_client = opcPlugin.MqttClient(general["mqtt_broker"],general["mqtt_port"],general["topic_name"],StubSnmpClient(),
+                                       general["publish_mode"],general["encoding"])
+    broker = LoopbackBroker()
+    mqtt_client.mqtt_client = broker
+    ctl = opcPlugin.Control(general["polling"],general["polling_change"],opc_client,mqtt_client)
+
+    # Measure poll and send stages
+    poll_times = []
+    send_times = []
+    samples = [0]
+    poll_data = ctl.pollData
+    send_data = mqtt_client.sendData
+    def timedPoll(scan_classes=None):
+        start = time.perf_counter()
+        data = poll_data(scan_classes)
+        poll_times.append((time.perf_counter() - start)*1000)
+        samples[0] += len(data)
+        return data
+    def timedSend(data):
+        start = time.perf_counter()
+        send_data(data)
+        send_times.append((time.perf_counter() - start)*1000)
+    ctl.pollData = timedPoll
+    mqtt_client.sendData = timedSend
+
+    ctl.start()
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    wall_start = time.monotonic()
+    runner = threading.Thread(target=ctl.run, daemon=True)
+    runner.start()
+    time.sleep(args.duration)
+    ctl.ready_flag = False
+    wall = time.monotonic() - wall_start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    runner.join(timeout=10)
+    time.sleep(0.5)
+    ctl.stop()
+
+    cpu = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+    result = {"samples_per_s": round(samples[0]/wall, 1),
+              "poll_ms": percentiles(poll_times),
+              "send_ms": percentiles(send_times),
+              "publish_to_receive_ms": percentiles(broker.latency),
+              "messages": broker.received,
+              "bytes": broker.bytes,
+              "cpu_pct": round(cpu/wall*100, 1),
+              "rss_mb": round(usage_end.ru_maxrss/1024, 1)}
+    result.update(ctl.getStats())
+    print(json.dumps(result))
+
+# Run one tag count -> the server runs here, the plugin in a child process
+def runCase(args, tags, directory):
+    server = SyntheticServer(args.port, tags, args.change_rate)
+    server.start()
+    try:
+        config = os.path.join(directory, "package_config_" + str(tags) + ".ini")
+        writeConfig(config, args, args.port, server.namespace, tags)
+        command = [sys.executable, os.path.abspath(__file__), "--child", "--config", config, "--duration", str(args.duration)]
+        output = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True, timeout=args.duration + 600)
+        return json.loads(output.stdout.strip().splitlines()[-1])
+    finally:
+        server.stop()
+
+# Print results and the relative change against the baseline
+def report(results, baseline):
+    keys = ("samples_per_s", "poll_ms", "send_ms", "publish_to_receive_ms", "cpu_pct", "rss_mb", "overruns", "missed_ticks", "dropped")
+    for tags, result in results.items():
+        print("tags=" + tags)
+        for key in keys:
+            line = "  " + key.ljust(24) + str(result[key])
+            if baseline is not None and tags in baseline and isinstance(result[key], (int, float)) and baseline[tags][key]:
+                line += "  (" + "{:+.1f}".format((result[key] - baseline[tags][key])/baseline[tags][key]*100) + "% vs baseline)"
+            print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the OPC/UA plugin")
+    parser.add_argument("--tags", default="10,100,1000,5000", help="comma separated tag counts")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds per tag count")
+    parser.add_argument("--polling", default="1", help="polling interval in seconds")
+    parser.add_argument("--change-rate", type=float, default=1, help="tag value changes per second")
+    parser.add_argument("--mode", default="poll", choices=("poll","batch","subscribe"))
+    parser.add_argument("--publish-mode", default="tag", choices=("tag","batch"))
+    parser.add_argument("--port", type=int, default=48400)
+    parser.add_argument("--save", help="store results as a baseline file")
+    parser.add_argument("--compare", help="compare results with a baseline file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        runChild(args)
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for tags in args.tags.split(","):
+            results[tags] = runCase(args, int(tags), directory)
+    report(results, baseline)
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+
+if __name__ == "__main__":
+    main()
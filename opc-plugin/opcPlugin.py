@@ -7,8 +7,33 @@ import json
 import logging
 import sys
 import time
+import datetime
 from pysnmp.hlapi import *
-import shelve
+import queue
+import threading
+import concurrent.futures
+import collections
+import math
+import bisect
+import http.server
+import socketserver
+import os
+import mmap
+import struct
+import urllib.parse
+import hashlib
+import random
+import zlib
+import argparse
+# Optional compact encodings for MQTT payloads
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
 
 ## TODO: Add Sphinx
 ## TODO: Add secure login methods
@@ -26,59 +51,612 @@ class SubHandler(object):
         self.control = Control()
         # Dict of status nodes -> remembers the last value to decide
         self.nodes = {}
+        # Map of node ids to lists of status variable names -> more variables can share one node
+        self.keys = {}
 
     # Check if PLC workload is running
     def checkProcess(self,node,val):
-        if val == 0:
-            # Process have stopped => reset/slow down polling interval 
-            self.control.resetPollInterval(self)
-        else:
-            # Process have started => change/speed up polling interval
-            self.control.changePollInterval()
+        for key in self.keys.get(node.nodeid, ()):
+            self.control.updateState(key, val)
 
     # Datachange event from the OPC/UA server
     def datachange_notification(self, node, val, data):
         #debug example: print("OPC/UA: New data change event", node, val,type(data),data)
 
-        if node in self.nodes:
-            # Check control value
-            self.checkProcess(node,val)
+        # Remember the last value and check control value
+        self.nodes[node] = val
+        self.checkProcess(node,val)
+
+# Handler class for OPC/UA data changes in the subscribe mode
+class DataChangeHandler(object):
+    """
+    Data change handler for the subscribe mode. Notifications are only
+    queued here, they are processed by the main loop when it drains the queue.
+    """
+    def __init__(self, keys):
+        # Map of node ids to lists of variable names -> more variables can share one node
+        self.keys = keys
+        # Received data changes -> (variable name, data value)
+        self.queue = queue.Queue()
+
+    # Datachange event from the OPC/UA server
+    def datachange_notification(self, node, val, data):
+        for key in self.keys.get(node.nodeid, ()):
+            self.queue.put((key, data.monitored_item.Value))
+
+# Parse duration from the configuration file -> 500ms, 60s, 5m, 1h or plain seconds
+def parseDuration(value):
+    value = str(value).strip()
+    for suffix, scale in (("ms",0.001),("s",1),("m",60),("h",3600)):
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)])*scale
+    return float(value)
+
+# Streaming statistics of one variable over a time window -> Welford algorithm, O(1) per sample
+class WindowAggregator:
+    FUNCTIONS = ("mean","min","max","count","stddev","last")
+
+    def __init__(self, functions, window):
+        self.functions = functions
+        self.window = window
+        self.reset(time.time())
+
+    # Start a new window
+    def reset(self, now):
+        self.start = now
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    # Add a sample
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta/self.count
+        self.m2 += delta*(value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.last = value
+
+    # Check if the window is over
+    def isComplete(self, now):
+        return now - self.start >= self.window
+
+    # Get summary of the window with configured functions
+    def summary(self):
+        stats = {"mean": self.mean, "min": self.min, "max": self.max, "count": self.count, "last": self.last,
+                 "stddev": math.sqrt(self.m2/(self.count - 1)) if self.count > 1 else 0.0}
+        return {function: stats[function] for function in self.functions}
+
+# Report by exception filter of one variable -> pass a value only if it moves over the deadband or the heartbeat expires
+class ExceptionFilter:
+    __slots__ = ("deadband", "deadband_pct", "heartbeat", "last_value", "last_time")
+
+    def __init__(self, deadband, deadband_pct, heartbeat):
+        self.deadband = deadband
+        self.deadband_pct = deadband_pct
+        self.heartbeat = heartbeat
+        # The last published value and its monotonic time
+        self.last_value = None
+        self.last_time = None
+
+    # Check if the value should be published
+    def check(self, value, now):
+        if self.last_time is None or (self.heartbeat > 0 and now - self.last_time >= self.heartbeat):
+            publish = True
         else:
-            # Create a first node
-            self.nodes[node] = val
-            self.checkProcess(node,val)
-            
+            try:
+                limit = max(self.deadband, abs(self.last_value)*self.deadband_pct/100)
+                publish = abs(value - self.last_value) > limit
+            # Non-numeric values are published on every change
+            except TypeError:
+                publish = value != self.last_value
+        if publish:
+            self.last_value = value
+            self.last_time = now
+        return publish
+
+# Scan class -> group of variables read on its own rate, the rate is switched by state variables of the group
+class ScanClass:
+    __slots__ = ("name", "rate", "idle_rate", "states", "next_tick", "interval")
+    # Variables without a scan class -> rate is driven by the polling and polling_change parameters
+    DEFAULT = "default"
+
+    def __init__(self, name, rate=None, idle_rate=None, states=()):
+        self.name = name
+        # Interval in seconds when the process is running and when it is idle
+        self.rate = rate
+        self.idle_rate = idle_rate if idle_rate is not None else rate
+        # Status variables of the group -> the process is running if one of them is not zero
+        self.states = tuple(states)
+        self.next_tick = 0
+        # Interval the next tick has been scheduled with -> None before the first tick
+        self.interval = None
+
+    # Move the next tick earlier if the interval has been shortened -> by the poll command or a state change
+    def reschedule(self, control):
+        interval = self.getInterval(control)
+        if self.interval is not None and interval < self.interval:
+            self.next_tick = max(self.next_tick - self.interval + interval, time.monotonic())
+            self.interval = interval
+
+    # Get current read interval
+    def getInterval(self, control):
+        if self.name == self.DEFAULT:
+            return float(control.poll_interval)
+        if len(self.states) == 0:
+            return self.rate
+        for state in self.states:
+            if control.states.get(state, 0) != 0:
+                return self.rate
+        return self.idle_rate
+
+# Processing plan of one variable -> compiled from its settings section at login
+class TagPlan:
+    __slots__ = ("role", "scan_class", "register_min", "register_max", "aggregator", "filter")
+    # Known parameters of variable sections
+    PARAMETERS = ("register", "state", "scan_class", "aggregate", "window", "deadband", "deadband_pct", "heartbeat")
+
+    def __init__(self, key, settings):
+        for param in settings:
+            if param not in self.PARAMETERS:
+                raise Exception("Unknown parameter of " + key + " -> " + param)
+        # Status variable
+        self.role = "status" if "state" in settings else "normal"
+        # Scan class of the variable
+        self.scan_class = settings.get("scan_class", ScanClass.DEFAULT)
+        # Local registers
+        self.register_min = False
+        self.register_max = False
+        if "register" in settings:
+            for config_param in settings["register"].split(","):
+                if config_param == "min":
+                    self.register_min = True
+                elif config_param == "max":
+                    self.register_max = True
+                else:
+                    raise Exception("Invalid option for register parameter of " + key + " -> " + config_param)
+        # Window aggregation
+        self.aggregator = None
+        if "aggregate" in settings:
+            functions = settings["aggregate"].split(",")
+            for function in functions:
+                if function not in WindowAggregator.FUNCTIONS:
+                    raise Exception("Invalid option for aggregate parameter of " + key + " -> " + function)
+            window = parseDuration(settings.get("window","60s"))
+            if window <= 0:
+                raise Exception("Window of " + key + " must be positive")
+            self.aggregator = WindowAggregator(functions, window)
+        # Report by exception
+        self.filter = None
+        if any(param in settings for param in ("deadband","deadband_pct","heartbeat")):
+            try:
+                deadband = float(settings.get("deadband","0"))
+                deadband_pct = float(settings.get("deadband_pct","0"))
+                heartbeat = parseDuration(settings.get("heartbeat","0"))
+            except ValueError as e:
+                raise Exception("Invalid deadband or heartbeat parameter of " + key + " -> " + str(e))
+            self.filter = ExceptionFilter(deadband, deadband_pct, heartbeat)
+
+# State of one variable kept over poll cycles -> processing plan, local registers and the last data value
+class TagState:
+    __slots__ = ("key", "plan", "min", "max", "register_timestamp", "data_value")
+
+    def __init__(self, key):
+        self.key = key
+        self.plan = None
+        # The last data value read from the server -> published again when a window closes without a new value
+        self.data_value = None
+        self.clear()
+
+    # Update local registers by a new value
+    def updateRegisters(self, value):
+        # Add timestmap for registers
+        if self.register_timestamp is None:
+            self.register_timestamp = time.time()*1000
+        if self.plan.register_min and (self.min is None or self.min > value):
+            self.min = value
+        if self.plan.register_max and (self.max is None or self.max < value):
+            self.max = value
+
+    # Clear local registers
+    def clear(self):
+        self.min = None
+        self.max = None
+        self.register_timestamp = None
+
+# Results of one poll cycle -> parallel lists addressed by the record index, frames are reused by the Control class
+class Frame:
+    __slots__ = ("size", "keys", "values", "statuses", "source_timestamps", "roles",
+                 "register_mins", "register_maxs", "register_timestamps", "aggregates")
+
+    def __init__(self, capacity=0):
+        self.size = 0
+        for name in self.__slots__[1:]:
+            setattr(self, name, [None]*capacity)
+
+    def __len__(self):
+        return self.size
+
+    # Keys of records like the keys of a dictionary
+    def __iter__(self):
+        return iter(self.keys[:self.size])
+
+    # Formatting for debug logs only
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    # Start a new cycle -> lists keep their capacity
+    def clear(self):
+        self.size = 0
+
+    # Add a record -> aggregate is None or (summary, window start, window end)
+    def append(self, key, value, status, source_timestamp, role, register_min="n/a", register_max="n/a", register_timestamp="n/a", aggregate=None):
+        index = self.size
+        if index == len(self.keys):
+            for name in self.__slots__[1:]:
+                getattr(self, name).extend([None]*max(index, 16))
+        self.keys[index] = key
+        self.values[index] = value
+        self.statuses[index] = status
+        self.source_timestamps[index] = source_timestamp
+        self.roles[index] = role
+        self.register_mins[index] = register_min
+        self.register_maxs[index] = register_max
+        self.register_timestamps[index] = register_timestamp
+        self.aggregates[index] = aggregate
+        self.size = index + 1
+
+    # Add records of another frame
+    def extend(self, other):
+        for index in range(other.size):
+            self.append(other.keys[index], other.values[index], other.statuses[index], other.source_timestamps[index], other.roles[index],
+                        other.register_mins[index], other.register_maxs[index], other.register_timestamps[index], other.aggregates[index])
+
+    # Record as a dictionary for publishing -> fields in the order of published messages
+    def record(self, index):
+        record = {"value": self.values[index], "status": self.statuses[index], "source_timestamp": self.source_timestamps[index],
+                  "role": self.roles[index], "register_min": self.register_mins[index], "register_max": self.register_maxs[index],
+                  "register_timestamp": self.register_timestamps[index]}
+        aggregate = self.aggregates[index]
+        if aggregate is not None:
+            record["aggregate"], record["window_start"], record["window_end"] = aggregate
+        return record
+
+    def items(self):
+        for index in range(self.size):
+            yield self.keys[index], self.record(index)
+
+# Persistent history of one variable -> memory mapped ring buffer of (timestamp, value) slots
+class HistoryRing:
+    # Header -> magic, slot count, index of the next slot, number of used slots
+    HEADER = struct.Struct("<4sIII")
+    SLOT = struct.Struct("<dd")
+    MAGIC = b"OPCH"
+
+    def __init__(self, filename, length):
+        self.length = int(length)
+        size = self.HEADER.size + self.length*self.SLOT.size
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT)
+        try:
+            resized = os.fstat(fd).st_size != size
+            if resized:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, length, self.head, self.count = self.HEADER.unpack_from(self.map, 0)
+        # New file or changed history length -> start with an empty history
+        if resized or magic != self.MAGIC or length != self.length:
+            if magic == self.MAGIC:
+                logging.warning("History length has changed, stored history is dropped -> " + filename)
+            self.head = 0
+            self.count = 0
+            self.HEADER.pack_into(self.map, 0, self.MAGIC, self.length, self.head, self.count)
+
+    # Add a new record and overwrite the oldest one if the buffer is full
+    def append(self, timestamp, value):
+        self.SLOT.pack_into(self.map, self.HEADER.size + self.head*self.SLOT.size, timestamp, value)
+        self.head = (self.head + 1) % self.length
+        if self.count < self.length:
+            self.count += 1
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, self.length, self.head, self.count)
+
+    # Position of a slot by the record index from the oldest one
+    def position(self, index):
+        return self.HEADER.size + ((self.head - self.count + index) % self.length)*self.SLOT.size
+
+    # Index of the first record newer than (after=True) or not older than the timestamp -> binary search, records are in time order
+    def find(self, timestamp, after=False):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high)//2
+            stored = self.SLOT.unpack_from(self.map, self.position(middle))[0]
+            if stored < timestamp or (after and stored == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Return stored records from the oldest one, optionally only in a time range
+    def items(self, start=None, end=None):
+        first = 0 if start is None else self.find(start)
+        last = self.count if end is None else self.find(end, after=True)
+        records = []
+        for index in range(first, last):
+            records.append(self.SLOT.unpack_from(self.map, self.position(index)))
+        return records
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+
+# Query of the stored history -> time range, downsampling and paging of the reply
+class HistoryQuery:
+    METHODS = ("lttb","minmax","nth")
+    PARAMETERS = ("id","key","from","to","max_points","method","page_size","compress")
+    __slots__ = ("id","key","start","end","max_points","method","page_size","compress")
+
+    def __init__(self, request):
+        for name in request:
+            if name not in self.PARAMETERS:
+                raise Exception("Unknown parameter of the history query -> " + str(name))
+        if "key" not in request:
+            raise Exception("Missing key of the history query")
+        self.id = request.get("id")
+        self.key = str(request["key"])
+        try:
+            self.start = float(request["from"]) if request.get("from") is not None else None
+            self.end = float(request["to"]) if request.get("to") is not None else None
+            self.max_points = int(request.get("max_points",0))
+            self.page_size = int(request.get("page_size",1000))
+        except (TypeError, ValueError) as e:
+            raise Exception("Invalid parameter of the history query -> " + str(e))
+        self.method = request.get("method","lttb")
+        if self.method not in self.METHODS:
+            raise Exception("Unknown downsampling method -> " + str(self.method))
+        if self.max_points < 0 or self.page_size < 1:
+            raise Exception("Max points must not be negative and page size must be positive")
+        self.compress = request.get("compress",True) not in (False,"False")
+
+    # Reduce points to the max points limit by the selected method
+    def downsample(self, points):
+        if self.max_points == 0 or len(points) <= self.max_points:
+            return points
+        if self.method == "lttb":
+            return downsampleLttb(points, self.max_points)
+        elif self.method == "minmax":
+            return downsampleMinMax(points, self.max_points)
+        return downsampleNth(points, self.max_points)
+
+    # Split points to reply pages
+    def pages(self, points):
+        pages = [points[index:index + self.page_size] for index in range(0, len(points), self.page_size)]
+        return pages if len(pages) > 0 else [[]]
+
+# Largest triangle three buckets downsampling -> keeps the visual shape of the series
+def downsampleLttb(points, threshold):
+    if threshold < 3:
+        return downsampleNth(points, threshold)
+    sampled = [points[0]]
+    every = (len(points) - 2)/(threshold - 2)
+    selected = 0
+    for bucket in range(threshold - 2):
+        # Average of the next bucket is the third point of the triangle
+        next_start = int((bucket + 1)*every) + 1
+        next_end = min(int((bucket + 2)*every) + 1, len(points))
+        next_points = points[next_start:next_end]
+        avg_x = sum(point[0] for point in next_points)/len(next_points)
+        avg_y = sum(point[1] for point in next_points)/len(next_points)
+        ax, ay = points[selected]
+        max_area = -1
+        for index in range(int(bucket*every) + 1, int((bucket + 1)*every) + 1):
+            area = abs((ax - avg_x)*(points[index][1] - ay) - (ax - points[index][0])*(avg_y - ay))
+            if area > max_area:
+                max_area = area
+                candidate = index
+        sampled.append(points[candidate])
+        selected = candidate
+    sampled.append(points[-1])
+    return sampled
+
+# Minimum and maximum of each bucket in time order -> keeps spikes of the series
+def downsampleMinMax(points, threshold):
+    # A bucket gives up to two points -> a smaller threshold takes every Nth point
+    if threshold < 2:
+        return downsampleNth(points, threshold)
+    buckets = threshold//2
+    every = len(points)/buckets
+    sampled = []
+    for bucket in range(buckets):
+        bucket_points = points[int(bucket*every):int((bucket + 1)*every)]
+        if len(bucket_points) == 0:
+            continue
+        low = min(bucket_points, key=lambda point: point[1])
+        high = max(bucket_points, key=lambda point: point[1])
+        if low is high:
+            sampled.append(low)
+        else:
+            sampled.extend(sorted((low, high), key=lambda point: point[0]))
+    return sampled
+
+# Every Nth point
+def downsampleNth(points, threshold):
+    return points[::math.ceil(len(points)/max(threshold, 1))]
+
+# Persistent cache of resolved nodes of one OPC/UA server -> valid while the namespace array of the server is unchanged
+class NodeCache:
+    def __init__(self, path, opc_url):
+        name = urllib.parse.quote(opc_url, safe="")
+        self.path = path
+        self.filename = os.path.join(path, name + ".nodes.json")
+        self.registers_filename = os.path.join(path, name + ".registers.json")
+        # Fingerprint of the namespace array and resolved nodes -> {address: {"nodeid": ..., "data_type": ...}}
+        self.fingerprint = None
+        self.nodes = {}
+        self.changed = False
+
+    # Load cached nodes -> the cache is invalidated if the namespace array has changed
+    def load(self, namespaces):
+        self.fingerprint = hashlib.sha1(json.dumps(namespaces).encode("utf-8")).hexdigest()
+        self.nodes = {}
+        self.changed = False
+        cache = self.read(self.filename)
+        if cache is None:
+            return
+        if cache.get("fingerprint") != self.fingerprint:
+            logging.warning("Namespace array of the OPC/UA server has changed, node cache is invalidated -> " + self.filename)
+            self.changed = True
+            return
+        self.nodes = cache.get("nodes", {})
+
+    def get(self, address):
+        return self.nodes.get(address)
+
+    def set(self, address, nodeid, data_type):
+        self.nodes[address] = {"nodeid": nodeid, "data_type": data_type}
+        self.changed = True
+
+    # Store resolved nodes if there is any change
+    def save(self):
+        if self.changed:
+            self.write(self.filename, {"fingerprint": self.fingerprint, "nodes": self.nodes})
+            self.changed = False
+
+    # Load the last snapshot of local registers
+    def loadRegisters(self):
+        registers = self.read(self.registers_filename)
+        return registers if isinstance(registers, dict) else {}
+
+    # Store a snapshot of local registers of variable states -> only numeric values can be restored
+    def saveRegisters(self, tags):
+        snapshot = {}
+        for key, tag in tags.items():
+            snapshot[key] = {name: value if isinstance(value, (int, float)) else None
+                             for name, value in (("min", tag.min), ("max", tag.max), ("register_timestamp", tag.register_timestamp))}
+        self.write(self.registers_filename, snapshot)
+
+    # Read a JSON file -> None if the file is missing or broken
+    def read(self, filename):
+        try:
+            with open(filename) as cache_file:
+                return json.load(cache_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning("Unable to read cache file " + filename + " -> " + str(e))
+            return None
+
+    # Write a JSON file atomically -> a power loss never leaves a broken file
+    def write(self, filename, content):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(filename + ".tmp", "w") as cache_file:
+                json.dump(content, cache_file)
+            os.replace(filename + ".tmp", filename)
+        except OSError as e:
+            logging.warning("Unable to write cache file " + filename + " -> " + str(e))
+
+# Delays of reconnect attempts -> exponential backoff with full jitter, so clients do not reconnect all at once
+class Backoff:
+    __slots__ = ("delay", "max_delay", "attempt")
+
+    def __init__(self, delay=1, max_delay=60):
+        self.delay = float(delay)
+        self.max_delay = float(max_delay)
+        self.attempt = 0
+
+    # Delay before the next attempt in seconds
+    def next(self):
+        delay = random.uniform(0, min(self.max_delay, self.delay*2**self.attempt))
+        self.attempt = min(self.attempt + 1, 32)
+        return max(delay, self.delay/10)
+
+    def reset(self):
+        self.attempt = 0
+
 # OpcClient class to handle all OPC/UA communication 
 class OpcClient:
-    def __init__(self, opc_url, variables, settings, persistency, history_length):
+    # Status codes of a lost session or connection -> other bad status codes are errors of variables
+    SESSION_ERRORS = (ua.StatusCodes.BadSessionIdInvalid, ua.StatusCodes.BadSessionClosed, ua.StatusCodes.BadSessionNotActivated,
+                      ua.StatusCodes.BadConnectionClosed, ua.StatusCodes.BadServerNotConnected, ua.StatusCodes.BadCommunicationError,
+                      ua.StatusCodes.BadSecureChannelIdInvalid, ua.StatusCodes.BadSecureChannelClosed, ua.StatusCodes.BadTimeout,
+                      ua.StatusCodes.BadShutdown, ua.StatusCodes.BadServerHalted)
+
+    def __init__(self, opc_url, variables, settings, persistency, history_length, mode="poll", sampling_interval=500, queue_size=1, deadband=0, history_path="/data/history", cache_path="/data/cache", reconnect_delay=1, reconnect_max_delay=60):
         # OPC/UA server url
         self.opc_url = opc_url
         # OPC/UA variables addresses
         self.variables = variables
+        # Resolved OPC/UA node objects -> cached at login
+        self.nodes = {}
+        # Acquisition mode -> poll (one read per variable), batch (one read request for all variables) or subscribe (data changes from the server)
+        self.mode = mode
+        # Prepared read requests for the batch mode -> {scan class: list of (keys, read parameters)}
+        self.read_batches = {}
+        # Variables of scan classes
+        self.scan_classes = {}
+        # Monitored items parameters for the subscribe mode
+        self.sampling_interval = float(sampling_interval)
+        self.queue_size = int(queue_size)
+        self.deadband = float(deadband)
+        # Data change subscription objects for the subscribe mode
+        self.data_handler = None
+        self.data_subscription = None
+        self.data_handles = {}
+        # The last client handle of monitored items -> handles must be unique in a subscription
+        self.client_handle = 0
         # OPC/UA variables config parameters
         self.settings = settings
         # subscription objects
         self.handlers = {}
         self.subscription = None
+        self.state_handler = None
         # OPC/UA connection from client to a server
         self.client = None
-        # Local registers
-        self.registers = {}
-        # State flag
-        self.init = True
+        # States of variables with local registers
+        self.tags = {}
         # Persistency flag
         self.persistency = persistency
         # History length allocation
         self.history_length = int(history_length)
+        # Processing plans of variables
+        self.plans = {}
+        self.timed_keys = []
+        self.metrics = Metrics()
+        # Location of history files and opened history buffers
+        self.history_path = history_path
+        self.history = {}
+        # Persistent cache of resolved nodes and snapshots of registers -> disabled without a cache path
+        self.node_cache = NodeCache(cache_path, opc_url) if cache_path else None
+        # Connection state -> logins run in a background thread with a backoff, so a server which does not answer never stalls the acquisition loop
+        self.connected = False
+        self.was_connected = False
+        self.login_attempts = 0
+        self.backoff = Backoff(reconnect_delay, reconnect_max_delay)
+        self.next_login = 0
+        self.reconnecting = False
+        self.reconnect_lock = threading.Lock()
+        self.stopping = threading.Event()
+        # Held by the login thread and by reads -> reads of a client which is just logging in are skipped
+        self.session_lock = threading.Lock()
+        # Reloaded variables and settings waiting for the end of a login -> (variables, settings)
+        self.pending_config = None
+        # Interval of session checks in the subscribe mode -> reads do not fail there if the session is lost
+        self.keepalive = 5
+        self.next_keepalive = 0
 
     # Create session to the OPC/UA server
     def login(self):
-        # Init local registers
-        for key, val in self.variables.items():
-            self.registers[key] = {}
-            self.registers[key]["min"] = None
-            self.registers[key]["max"] = None
-            self.registers[key]["register_timestamp"] = None
+        self.compilePlans()
+        if self.persistency == "True":
+            self.openHistory()
 
         # Create session
         try:
@@ -87,119 +665,603 @@ class OpcClient:
         except Exception as e:
             raise Exception("OPC/UA server is not available. Please check connectivity by cmd tools")
         logging.info("Client connected to a OPC/UA server" + str(self.opc_url))
-        
+
+        self.resolveNodes()
+        # Status variables are subscribed in every session
+        for key, plan in self.plans.items():
+            if plan.role == "status" and key in self.nodes:
+                self.createSubscription(self.variables[key], key)
+        if self.mode == "batch":
+            self.prepareBatchRead()
+        elif self.mode == "subscribe":
+            self.createDataSubscription()
+        self.connected = True
+        self.was_connected = True
+        self.next_keepalive = time.monotonic() + self.keepalive
+
+    # Session has been lost -> the login thread drops it and logs in again after the backoff delay
+    def connectionLost(self, error):
+        logging.error("OPC/UA connection to " + self.opc_url + " has been lost -> " + (str(error) or type(error).__name__))
+        self.metrics.inc("opc_disconnects")
+        self.connected = False
+        self.next_login = time.monotonic() + self.backoff.next()
+        self.startReconnect()
+
+    # Start the login thread unless it is running
+    def startReconnect(self):
+        with self.reconnect_lock:
+            if self.reconnecting:
+                return
+            self.reconnecting = True
+        threading.Thread(target=self.reconnectLoop, name="opc-reconnect", daemon=True).start()
+
+    # Login until the session is established -> reloaded configuration is applied between attempts
+    def reconnectLoop(self):
+        while True:
+            with self.session_lock:
+                self.applyPendingConfig()
+            with self.reconnect_lock:
+                if (self.connected or self.stopping.is_set()) and self.pending_config is None:
+                    self.reconnecting = False
+                    return
+            if self.connected or self.stopping.wait(max(self.next_login - time.monotonic(), 0)):
+                continue
+            with self.session_lock:
+                self.dropSession()
+                self.reconnect()
+
+    # Stop the login thread
+    def stopReconnect(self):
+        self.stopping.set()
+
+    # Drop the session, its nodes and subscriptions -> the server may be gone, so errors are ignored
+    def dropSession(self):
+        if self.client is not None:
+            try:
+                self.client.disconnect()
+            except Exception as e:
+                logging.debug("Unable to close the lost OPC/UA session -> " + str(e))
+        # Nodes are bound to the session -> the next login resolves them again, so a variable which can not be resolved any more is not read
+        self.nodes = {}
+        self.subscription = None
+        self.state_handler = None
+        self.handlers = {}
+        self.data_subscription = None
+        self.data_handles = {}
+
+    # Login once -> return True if the session is established, a failed attempt schedules the next one
+    def reconnect(self):
+        restored = self.was_connected
+        try:
+            self.login()
+        except Exception as e:
+            self.dropSession()
+            delay = self.backoff.next()
+            self.next_login = time.monotonic() + delay
+            logging.warning("OPC/UA login to " + self.opc_url + " failed, next attempt in " + str(round(delay, 1)) + " s -> " + str(e))
+            return False
+        finally:
+            self.login_attempts += 1
+        self.backoff.reset()
+        if restored:
+            self.metrics.inc("opc_reconnects")
+            logging.info("OPC/UA connection to " + self.opc_url + " has been restored")
+        return True
+
+    # Check the session in the subscribe mode by reading the server state
+    def checkSession(self):
+        now = time.monotonic()
+        if self.mode == "subscribe" and now >= self.next_keepalive:
+            self.next_keepalive = now + self.keepalive
+            self.client.get_node(ua.ObjectIds.Server_ServerStatus_State).get_value()
+
+    # Resolve nodes only once and reuse them for every poll -> variables which can not be resolved are skipped until the next login
+    def resolveNodes(self, keys=None):
+        if keys is None:
+            keys = list(self.variables.keys())
+        self.nodes.update(self.resolveAddresses({key: self.variables[key] for key in keys}))
+
+    # Resolve addresses of variables -> {key: node}, resolved NodeIds are cached persistently
+    # An unknown address is logged and skipped, lost connections still raise
+    def resolveAddresses(self, addresses):
+        nodes = {}
+        if len(addresses) == 0:
+            return nodes
+        resolved = []
+        if self.node_cache is not None:
+            self.node_cache.load(self.client.get_namespace_array())
+        for key, val in addresses.items():
+            cached = self.node_cache.get(val) if self.node_cache is not None else None
+            if cached is not None:
+                nodes[key] = self.client.get_node(cached["nodeid"])
+                continue
+            try:
+                nodes[key] = self.resolveAddress(val)
+            except ua.UaStatusCodeError as e:
+                if e.code in self.SESSION_ERRORS:
+                    raise
+                logging.error("Unable to resolve OPC/UA address " + val + " of " + key + " -> " + str(e))
+                continue
+            except ua.UaStringParsingError as e:
+                logging.error("Unable to resolve OPC/UA address " + val + " of " + key + " -> " + str(e))
+                continue
+            resolved.append(key)
+        if self.node_cache is not None and len(resolved) > 0:
+            data_types = self.readDataTypes({key: nodes[key] for key in resolved})
+            for key in resolved:
+                self.node_cache.set(addresses[key], nodes[key].nodeid.to_string(), data_types.get(key))
+            self.node_cache.save()
+        logging.info("OPC/UA nodes resolved -> " + str(len(nodes) - len(resolved)) + " from the cache, " + str(len(resolved)) + " from the server, " +
+                     str(len(addresses) - len(nodes)) + " failed")
+        return nodes
+
+    # Resolve an address -> NodeId (ns=2;s=Tag) or browse path from the root node (/0:Objects/2:PLC/2:Tag)
+    def resolveAddress(self, address):
+        if address.startswith("/"):
+            return self.client.get_root_node().get_child(address.strip("/").split("/"))
+        return self.client.get_node(address)
+
+    # Read data types of nodes -> {key: data type NodeId}
+    def readDataTypes(self, nodes):
+        keys = list(nodes.keys())
+        data_types = {}
+        chunk_size = self.readLimit() or len(keys)
+        try:
+            for index in range(0, len(keys), chunk_size):
+                chunk = keys[index:index+chunk_size]
+                params = ua.ReadParameters()
+                for key in chunk:
+                    rv = ua.ReadValueId()
+                    rv.NodeId = nodes[key].nodeid
+                    rv.AttributeId = ua.AttributeIds.DataType
+                    params.NodesToRead.append(rv)
+                for key, result in zip(chunk, self.client.uaclient.read(params)):
+                    if result.StatusCode.is_good():
+                        data_types[key] = result.Value.Value.to_string()
+        except Exception as e:
+            logging.warning("Unable to read data types of variables -> " + str(e))
+        return data_types
+
+    # Read the MaxNodesPerRead limit of the server -> 0 if there is no limit
+    def readLimit(self):
+        try:
+            return int(self.client.get_node(ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxNodesPerRead).get_value())
+        except Exception as e:
+            logging.warning("Unable to read MaxNodesPerRead from the OPC/UA server, variables will be read in one request -> " + str(e))
+            return 0
+
+    # Store a snapshot of local registers next to the node cache
+    def saveRegisters(self):
+        if self.node_cache is not None:
+            self.node_cache.saveRegisters(self.tags)
+
+    # Prepare read requests for the batch mode -> chunks are sized to the server MaxNodesPerRead limit
+    def prepareBatchRead(self):
+        limit = self.readLimit()
+        # Variables of one scan class are read together
+        self.read_batches = {}
+        for scan_class, keys in self.scan_classes.items():
+            # Variables which have not been resolved are not read
+            keys = [key for key in keys if key in self.nodes]
+            chunk_size = limit if limit > 0 else max(len(keys), 1)
+            self.read_batches[scan_class] = []
+            for index in range(0, len(keys), chunk_size):
+                chunk = keys[index:index+chunk_size]
+                params = ua.ReadParameters()
+                params.TimestampsToReturn = ua.TimestampsToReturn.Source
+                for key in chunk:
+                    rv = ua.ReadValueId()
+                    rv.NodeId = self.nodes[key].nodeid
+                    rv.AttributeId = ua.AttributeIds.Value
+                    params.NodesToRead.append(rv)
+                self.read_batches[scan_class].append((chunk, params))
+            logging.info("Batch read prepared for " + str(len(keys)) + " variables of scan class " + scan_class + " in " + str(len(self.read_batches[scan_class])) + " request(s)")
+
     # Logout from the OPC/UA server
     def logout(self):
+        self.connected = False
         try:
+            if self.data_subscription is not None:
+                self.data_subscription.delete()
+                self.data_subscription = None
             self.client.disconnect()
         except Exception as e:
             raise Exception("OPC/UA server is not available for logout command. Please check connectivity by cmd tools")
+        finally:
+            self.closeHistory()
+            self.saveRegisters()
         logging.info("Logout form OPC/UA server")
 
+    # Compile processing plans of variables -> invalid settings raise an exception at login
+    def compilePlans(self):
+        self.initTags()
+        for key, val in self.variables.items():
+            if key not in self.plans:
+                self.plans[key] = TagPlan(key, self.settings.get(key, {}))
+            self.tags[key].plan = self.plans[key]
+        # Variables of scan classes in the configuration order
+        self.scan_classes = {}
+        for key in self.variables:
+            self.scan_classes.setdefault(self.plans[key].scan_class, []).append(key)
+        # Variables with time driven records -> checked in every cycle even without a new value
+        self.timed_keys = [key for key in self.variables if self.plans[key].aggregator is not None or
+                           (self.plans[key].filter is not None and self.plans[key].filter.heartbeat > 0)]
+
+    # Create states of new variables -> local registers are restored from the last snapshot at start
+    def initTags(self):
+        snapshot = {}
+        if len(self.tags) == 0 and self.node_cache is not None:
+            snapshot = self.node_cache.loadRegisters()
+        restored = 0
+        for key in self.variables:
+            if key in self.tags:
+                continue
+            self.tags[key] = TagState(key)
+            if key in snapshot:
+                self.tags[key].min = snapshot[key].get("min")
+                self.tags[key].max = snapshot[key].get("max")
+                self.tags[key].register_timestamp = snapshot[key].get("register_timestamp")
+                restored += 1
+        if restored > 0:
+            logging.info("Local registers restored for " + str(restored) + " variables")
+
+    # Apply reloaded variables and settings -> only added, removed and changed variables are touched, others keep their state
+    # A running login applies them itself when it is done
+    def reconfigure(self, variables, settings):
+        self.pending_config = (variables, settings)
+        if self.session_lock.acquire(blocking=False):
+            try:
+                self.applyPendingConfig()
+            finally:
+                self.session_lock.release()
+
+    # Apply reloaded variables and settings waiting for the session lock
+    def applyPendingConfig(self):
+        if self.pending_config is not None:
+            variables, settings = self.pending_config
+            self.pending_config = None
+            self.applyConfig(variables, settings)
+
+    # Compare reloaded variables and settings with the running ones and update the session
+    def applyConfig(self, variables, settings):
+        # New addresses are resolved before anything is changed -> a variable which can not be resolved keeps its running address or is not added
+        nodes = {}
+        if self.connected:
+            addresses = {key: address for key, address in variables.items() if self.variables.get(key) != address}
+            try:
+                nodes = self.resolveAddresses(addresses)
+            except Exception as e:
+                self.connectionLost(e)
+            else:
+                failed = [key for key in addresses if key not in nodes]
+                if len(failed) > 0:
+                    logging.error("OPC/UA variables not reloaded for " + self.opc_url + " -> " + ", ".join(failed))
+                    variables = {key: address if key not in failed else self.variables[key] for key, address in variables.items() if key not in failed or key in self.variables}
+        # Variables with a new address are removed and added again, variables with new settings get a new plan
+        removed = [key for key in self.variables if variables.get(key) != self.variables[key]]
+        changed = [key for key in self.variables if key in variables and key not in removed and settings.get(key, {}) != self.settings.get(key, {})]
+        for key in removed + changed:
+            self.removeVariable(key)
+        for key in removed:
+            self.tags.pop(key, None)
+            if key in self.history and key not in variables:
+                self.history.pop(key).close()
+        self.variables = variables
+        self.settings = settings
+        added = [key for key in variables if key not in self.plans]
+        self.compilePlans()
+        if self.persistency == "True":
+            self.openHistory()
+
+        # Without a session the next login prepares everything
+        if self.connected:
+            try:
+                # Variables with new settings have the same address and are resolved again from the cache or the server
+                self.nodes.update({key: node for key, node in nodes.items() if key in added})
+                self.resolveNodes([key for key in added if key not in self.nodes])
+                added = [key for key in added if key in self.nodes]
+                for key in added:
+                    if self.plans[key].role == "status":
+                        self.createSubscription(self.variables[key], key)
+                if self.mode == "batch":
+                    self.prepareBatchRead()
+                elif self.mode == "subscribe" and len(added) > 0:
+                    self.monitorVariables(added)
+            except Exception as e:
+                self.connectionLost(e)
+        deleted = [key for key in removed if key not in variables]
+        logging.info("OPC/UA variables reloaded for " + self.opc_url + " -> added " + str(len([key for key in added if key not in removed + changed])) +
+                     ", removed " + str(len(deleted)) + ", changed " + str(len(removed) - len(deleted) + len(changed)))
+
+    # Remove a variable from the session -> subscriptions, read requests and plan
+    def removeVariable(self, key):
+        self.plans.pop(key, None)
+        node = self.nodes.pop(key, None)
+        address = self.variables[key]
+        try:
+            # Monitored items shared with other variables of the same node are kept
+            if address in self.handlers:
+                keys = self.state_handler.keys.get(node.nodeid, [])
+                if key in keys:
+                    keys.remove(key)
+                if not any(self.variables.get(other) == address for other in keys):
+                    handle = self.handlers.pop(address)
+                    if len(keys) == 0:
+                        self.state_handler.keys.pop(node.nodeid, None)
+                    if self.connected:
+                        self.subscription.unsubscribe(handle)
+            if self.data_handler is not None and node is not None:
+                keys = self.data_handler.keys.get(node.nodeid, [])
+                if key in keys:
+                    keys.remove(key)
+                if len(keys) == 0:
+                    self.data_handler.keys.pop(node.nodeid, None)
+            if key in self.data_handles:
+                handle = self.data_handles.pop(key)
+                if self.connected and handle not in self.data_handles.values():
+                    self.data_subscription.unsubscribe(handle)
+        except Exception as e:
+            logging.warning("Unable to delete monitored item of " + key + " -> " + str(e))
+
+    # Add a sample to the window aggregator -> return (summary, window start, window end) if the window summary should be published
+    def aggregateData(self, value, key, aggregator):
+        try:
+            aggregator.add(float(value))
+        except (TypeError, ValueError):
+            logging.debug("Only numeric values can be aggregated -> " + key)
+        now = time.time()
+        if not aggregator.isComplete(now):
+            return None
+        return self.closeWindow(aggregator, now)
+
+    # Close the window of an aggregator -> (summary, window start, window end)
+    def closeWindow(self, aggregator, now):
+        aggregate = (aggregator.summary(), aggregator.start*1000, now*1000)
+        aggregator.reset(now)
+        return aggregate
+
+    # Publish records of variables without a new value in this cycle -> windows of aggregated variables are closed
+    # and the last value is published again when the heartbeat expires, data changes of the subscribe mode may not come for a long time
+    def sweepTags(self, values, frame):
+        now = time.time()
+        monotonic = time.monotonic()
+        for key in self.timed_keys:
+            if key in values:
+                continue
+            tag = self.tags[key]
+            plan = tag.plan
+            if plan.aggregator is not None:
+                if not plan.aggregator.isComplete(now):
+                    continue
+                # Empty windows have no summary
+                if plan.aggregator.count == 0 or tag.data_value is None:
+                    plan.aggregator.reset(now)
+                    continue
+                self.appendRecord(frame, tag, tag.data_value, self.closeWindow(plan.aggregator, now))
+            elif tag.data_value is not None and plan.filter.check(tag.data_value.Value.Value, monotonic):
+                self.appendRecord(frame, tag, tag.data_value)
+
+    # Add a record of a variable with its last registers to the frame
+    def appendRecord(self, frame, tag, data_value, aggregate=None):
+        plan = tag.plan
+        register_min = tag.min if plan.register_min and tag.register_timestamp is not None else "n/a"
+        register_max = tag.max if plan.register_max and tag.register_timestamp is not None else "n/a"
+        register_timestamp = tag.register_timestamp if register_min != "n/a" or register_max != "n/a" else "n/a"
+        frame.append(tag.key, data_value.Value.Value, data_value.StatusCode.name, self.toTimestamp(data_value.SourceTimestamp), plan.role,
+                     register_min, register_max, register_timestamp, aggregate)
+
     # Clear value of local registers
     def clearRegister(self, name):
-        self.registers[name]["min"] = None
-        self.registers[name]["max"] = None
-        self.registers[name]["register_timestamp"] = None
+        self.tags[name].clear()
+
+    # Open history buffers of all variables -> files are opened only once and kept open
+    def openHistory(self):
+        os.makedirs(self.history_path, exist_ok=True)
+        for key in self.variables:
+            if key not in self.history:
+                filename = os.path.join(self.history_path, urllib.parse.quote(key, safe="") + ".ring")
+                self.history[key] = HistoryRing(filename, self.history_length)
+        logging.info("History buffers opened in " + self.history_path)
+
+    # Close history buffers
+    def closeHistory(self):
+        for ring in self.history.values():
+            ring.close()
+        self.history = {}
 
     # Store data persistently
-    def storeData(self,data,key):
-        pd = shelve.open(self.persist_data)
+    def storeData(self,value,key):
         try:
-            tmp_value = data["value"]
-            old_persist_value = pd[key]["value"]
-            # Check lenght of stored data
-            if len(old_persist_value) <= self.history_length:
-                data["value"] = old_persist_value.append(tmp_value)
-                pd[key] = data 
-            else:
-                # Remove the oldest value
-                old_persist_value.pop(0)
-                data["value"] = old_persist_value.append(tmp_value)
-                pd[key] = data 
-                
-        except Exception as e:
-            # Init data structure for the key
-            data["value"] = [data["value"]]
-            pd[key] = data
+            self.history[key].append(time.time()*1000, float(value))
+        except (TypeError, ValueError):
+            logging.debug("Only numeric values can be stored in the history -> " + key)
 
-        pd.close()
+    # Return stored persistent data -> list of [timestamp, value] from the oldest record, optionally only in a time range in ms
+    def getStoredData(self, key, start=None, end=None):
+        if key not in self.history:
+            return None
+        return [list(record) for record in self.history[key].items(start, end)]
 
-    # Return stored persistent data
-    def getStoredData(self, key):
-        pd = shelve.open(self.persist_data)
-        data = pd.get(key)
-        pd.close()
-        return data
+    # Convert OPC/UA timestamp to ms
+    def toTimestamp(self, value):
+        if value is None:
+            return "n/a"
+        return (value - datetime.datetime(1970, 1, 1)).total_seconds()*1000
 
-    # TODO: Create support for more status variables -> right now the self.init flag is a limitation
-    # Read data from OPC/UA server from predifined variables
-    def pollData(self):
-        data = {}
-        for key, val in self.variables.items():
-            node = self.client.get_node(val) 
-            data[key] = {}
-            data[key]["value"] = node.get_value()
-            data[key]["role"] = "normal"
-            data[key]["register_min"] = "n/a"
-            data[key]["register_max"] = "n/a"
-            data[key]["register_timestamp"] = "n/a"
-            # Custom configuration parameters
-            try:
-                for param_key, param_val in self.settings[key].items():
-                    # Add settings parameters to the data structure
-                    if param_key == "register":
-                        config = param_val.split(",")
-                        for config_param in config:
-                            if config_param == "min":
-                                # Check and init the first value
-                                if self.registers[key]["min"] == None:
-                                    self.registers[key]["min"] = data[key]["value"]
-                                    # Add timestmap for registers
-                                    if self.registers[key]["register_timestamp"] == None:
-                                        self.registers[key]["register_timestamp"] = time.time()*1000
-                                        data[key]["register_timestamp"] = time.time()*1000
-
-                                elif int(self.registers[key]["min"]) > int(data[key]["value"]):
-                                    self.registers[key]["min"] = data[key]["value"]
-                                data[key]["register_min"] = self.registers[key]["min"]
-                                data[key]["register_timestamp"] = self.registers[key]["register_timestamp"]
-                            elif config_param == "max":
-                                # Check and init the first value
-                                if self.registers[key]["max"] == None:
-                                    self.registers[key]["max"] = data[key]["value"]
-                                    # Add timestmap for registers
-                                    if self.registers[key]["register_timestamp"] == None:
-                                        self.registers[key]["register_timestamp"] = time.time()*1000
-                                        data[key]["register_timestamp"] = time.time()*1000
-
-                                elif int(self.registers[key]["max"]) < int(data[key]["value"]):
-                                    self.registers[key]["max"] = data[key]["value"]
-                                data[key]["register_max"] = self.registers[key]["max"]
-                                data[key]["register_timestamp"] = self.registers[key]["register_timestamp"]
-                            else:
-                                logging.error("Invalid option for register parameter in the configuration file")
-                    if param_key == "state" and self.init:
-                        # Create subription
-                        self.createSubscription(val)
-                        self.init = False
-                    if param_key == "state":
-                        data[key]["role"] = "status"
-            # Key for specific configuration does not exist
-            except Exception as e:
-                pass
+    # Read current data values of scan classes -> one request per variable, one request per batch or changes queued by the subscription
+    def readValues(self, scan_classes=None):
+        values = {}
+        if scan_classes is None:
+            scan_classes = list(self.scan_classes.keys())
+        if self.mode == "subscribe":
+            # Drain queued data changes, the latest value of a variable wins -> changes of variables removed by a reload are dropped
+            while True:
+                try:
+                    key, value = self.data_handler.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if key in self.tags:
+                    values[key] = value
+        elif self.mode == "batch":
+            for scan_class in scan_classes:
+                for keys, params in self.read_batches.get(scan_class, ()):
+                    results = self.client.uaclient.read(params)
+                    for key, result in zip(keys, results):
+                        values[key] = result
+        else:
+            for scan_class in scan_classes:
+                for key in self.scan_classes.get(scan_class, ()):
+                    node = self.nodes.get(key)
+                    if node is None:
+                        continue
+                    # Bad status of one variable is reported like in the batch mode -> the rest of the cycle is read
+                    try:
+                        values[key] = node.get_data_value()
+                    except ua.UaStatusCodeError as e:
+                        if e.code in self.SESSION_ERRORS:
+                            raise
+                        values[key] = ua.DataValue(status=ua.StatusCode(e.code))
+        return values
 
-            if self.persistency == "True":
-                storeData(data[key],key)
+    # Read data from OPC/UA server from predifined variables -> all variables or variables of given scan classes
+    # Records are added to the given frame -> a new one is used without it
+    def pollData(self, scan_classes=None, frame=None):
+        if frame is None:
+            frame = Frame()
+        # Lost session or a running login -> no data until the login thread is done, other servers are polled as usual
+        if not self.connected or not self.session_lock.acquire(blocking=False):
+            return frame
+        size = frame.size
+        try:
+            self.checkSession()
+            with self.metrics.time("poll"):
+                return self.processData(scan_classes, frame)
+        except ua.UaStatusCodeError as e:
+            if e.code not in self.SESSION_ERRORS:
+                raise
+            self.connectionLost(e)
+        except (OSError, TimeoutError, ua.UaError, concurrent.futures.TimeoutError) as e:
+            self.connectionLost(e)
+        finally:
+            self.session_lock.release()
+        frame.size = size
+        return frame
 
-        return data
+    # Process data values from the OPC/UA server
+    def processData(self, scan_classes=None, frame=None):
+        if frame is None:
+            frame = Frame()
+        with self.metrics.time("read"):
+            values = self.readValues(scan_classes)
+        store_time = 0
+        persistency = self.persistency == "True"
+        for key, data_value in values.items():
+            tag = self.tags[key]
+            tag.data_value = data_value
+            plan = tag.plan
+            value = data_value.Value.Value
+            register_min = register_max = register_timestamp = "n/a"
+            # Bad values have no value to process
+            if value is not None and (plan.register_min or plan.register_max):
+                tag.updateRegisters(value)
+                register_timestamp = tag.register_timestamp
+                if plan.register_min:
+                    register_min = tag.min
+                if plan.register_max:
+                    register_max = tag.max
+
+            if persistency:
+                start = time.perf_counter()
+                self.storeData(value,key)
+                store_time += time.perf_counter() - start
+
+            # Only window summaries are published for aggregated variables
+            aggregate = None
+            if plan.aggregator is not None:
+                aggregate = self.aggregateData(value,key,plan.aggregator)
+                if aggregate is None:
+                    continue
+            # Report by exception -> skip values within the deadband
+            elif plan.filter is not None and not plan.filter.check(value,time.monotonic()):
+                continue
+            frame.append(key, value, data_value.StatusCode.name, self.toTimestamp(data_value.SourceTimestamp), plan.role,
+                         register_min, register_max, register_timestamp, aggregate)
+
+        if len(self.timed_keys) > 0:
+            self.sweepTags(values, frame)
+        if persistency:
+            self.metrics.observe("store", store_time)
+        return frame
          
-    # Create a subscription and store the connection handle
-    def createSubscription(self, address):
+    # Create monitored items for all variables in the subscribe mode
+    def createDataSubscription(self):
+        try:
+            self.data_handler = DataChangeHandler({})
+            self.data_subscription = self.client.create_subscription(self.sampling_interval, self.data_handler)
+            self.monitorVariables(list(self.nodes.keys()))
+        except Exception as e:
+            raise Exception("Unable to create data subscription to OPC/UA server -> " + str(e))
+        logging.info("Data subscription created for " + str(len(self.data_handles)) + " variables")
+
+    # Create monitored items of variables in the data subscription -> variables of the same node share one monitored item
+    def monitorVariables(self, keys):
+        requests = []
+        monitored = []
+        for key in keys:
+            node_keys = self.data_handler.keys.setdefault(self.nodes[key].nodeid, [])
+            node_keys.append(key)
+            if len(node_keys) > 1:
+                continue
+            self.client_handle += 1
+            monitored.append(key)
+            requests.append(self.createMonitoredItemRequest(self.nodes[key], self.client_handle))
+        results = self.data_subscription.create_monitored_items(requests) if len(requests) > 0 else []
+        for key, result in zip(monitored, results):
+            if isinstance(result, ua.StatusCode):
+                logging.error("Unable to monitor variable " + key + " -> " + str(result.name))
+            else:
+                self.data_handles[key] = result
+        for key in keys:
+            first = self.data_handler.keys[self.nodes[key].nodeid][0]
+            if key != first and first in self.data_handles:
+                self.data_handles[key] = self.data_handles[first]
+
+    # Prepare a monitored item with sampling interval, queue size and deadband filter
+    def createMonitoredItemRequest(self, node, handle):
+        rv = ua.ReadValueId()
+        rv.NodeId = node.nodeid
+        rv.AttributeId = ua.AttributeIds.Value
+        params = ua.MonitoringParameters()
+        params.ClientHandle = handle
+        params.SamplingInterval = self.sampling_interval
+        params.QueueSize = self.queue_size
+        params.DiscardOldest = True
+        if self.deadband > 0:
+            mfilter = ua.DataChangeFilter()
+            mfilter.Trigger = ua.DataChangeTrigger.StatusValue
+            mfilter.DeadbandType = ua.DeadbandType.Absolute
+            mfilter.DeadbandValue = self.deadband
+            params.Filter = mfilter
+        request = ua.MonitoredItemCreateRequest()
+        request.ItemToMonitor = rv
+        request.MonitoringMode = ua.MonitoringMode.Reporting
+        request.RequestedParameters = params
+        return request
+
+    # Create a subscription of a status variable and store the connection handle -> all status variables share one subscription
+    def createSubscription(self, address, key=None):
         try:
-            handler = SubHandler()
-            self.subscription = self.client.create_subscription(500, handler)
-            handle = self.subscription.subscribe_data_change(self.client.get_node(address))
+            if self.subscription is None:
+                self.state_handler = SubHandler()
+                self.subscription = self.client.create_subscription(500, self.state_handler)
+            node = self.nodes[key] if key in self.nodes else self.client.get_node(address)
+            node_keys = self.state_handler.keys.setdefault(node.nodeid, [])
+            if key not in node_keys:
+                node_keys.append(key)
+            # Status variables of the same address share one monitored item
+            if address in self.handlers:
+                return
+            handle = self.subscription.subscribe_data_change(node)
             self.handlers[address] = handle
         except Exception as e:
             raise Exception("Unable to create subscription to OPC/UA server address", address)
@@ -227,104 +1289,768 @@ class OpcClient:
 
 # SNMP class to communicate with IOS-XE part 
 class SnmpClient:
-    def __init__(self, gw_ip, community):
+    def __init__(self, gw_ip, community, refresh=10, ttl=60, fallback="50.0754072,14.4165971"):
         self.gw_ip = gw_ip
         self.community = community
         self.oid = {"latitude": "iso.3.6.1.4.1.9.9.661.1.4.1.1.1.4.4038",
                     "longtitude": "iso.3.6.1.4.1.9.9.661.1.4.1.1.1.5.4038",
                     "timestamp": "iso.3.6.1.4.1.9.9.661.1.4.1.1.1.6.4038"
                     }
+        # Long-lived SNMP engine and request objects
+        self.engine = SnmpEngine()
+        self.auth = CommunityData(self.community)
+        self.target = UdpTransportTarget((self.gw_ip, 161))
+        self.objects = [ObjectType(ObjectIdentity(val)) for val in self.oid.values()]
+        # Sampler refresh interval and max age of a GPS fix in seconds
+        self.refresh = float(refresh)
+        self.ttl = float(ttl)
+        # Static position used when GPS is not working -> Charles Square, Prague, CZE
+        self.fallback = tuple(float(val) for val in fallback.split(","))
+        # The last GPS fix and its monotonic time
+        self.fix = None
+        self.fix_time = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.sampler = None
 
-    # Get GPS coordinates from IR1101 Cellular module
-    def getCoordinates(self):
+    # Read GPS coordinates from IR1101 Cellular module -> all OIDs in one request
+    def readCoordinates(self):
         coordinates = {"latitude":0,"longtitude":0,"timestamp":0}
-        for key,val in self.oid.items():
-            iterator = getCmd(SnmpEngine(),
-                    CommunityData(self.community),
-                    UdpTransportTarget((self.gw_ip, 161)),
-                    ContextData(),
-                    ObjectType(ObjectIdentity(val)))
-            errorIndication, errorStatus, errorIndex, varBinds = next(iterator)
-            for varBind in varBinds:
-                # Reformat timestamp vlaue to a human string
-                if key == "timestamp":
-                    coordinates[key] = bytes.fromhex(varBind.prettyPrint().split("=")[1].strip()[2:]).decode("utf-8")[:-1]
-                else:
-                    coordinates[key] = varBind.prettyPrint().split("=")[1].strip()[2:]
+        iterator = getCmd(self.engine, self.auth, self.target, ContextData(), *self.objects)
+        errorIndication, errorStatus, errorIndex, varBinds = next(iterator)
+        if errorIndication or errorStatus:
+            raise Exception("SNMP request failed -> " + str(errorIndication or errorStatus.prettyPrint()))
+        for key, varBind in zip(self.oid.keys(), varBinds):
+            # Reformat timestamp vlaue to a human string
+            if key == "timestamp":
+                coordinates[key] = bytes.fromhex(varBind.prettyPrint().split("=")[1].strip()[2:]).decode("utf-8")[:-1]
+            else:
+                coordinates[key] = varBind.prettyPrint().split("=")[1].strip()[2:]
         return coordinates
+
+    # Refresh the GPS fix periodically
+    def sample(self):
+        while not self.stop_event.is_set():
+            try:
+                with Metrics().time("snmp"):
+                    coordinates = self.readCoordinates()
+                with self.lock:
+                    self.fix = coordinates
+                    self.fix_time = time.monotonic()
+            except Exception as e:
+                logging.warning("Unable to read GPS coordinates -> " + str(e))
+            self.stop_event.wait(self.refresh)
+
+    # Start the background GPS sampler
+    def start(self):
+        if self.sampler is not None and self.sampler.is_alive():
+            return
+        self.stop_event.clear()
+        self.sampler = threading.Thread(target=self.sample, name="gps-sampler", daemon=True)
+        self.sampler.start()
+        logging.info("GPS sampler has started")
+
+    # Stop the background GPS sampler
+    def stop(self):
+        self.stop_event.set()
+
+    # Get the cached GPS coordinates -> None if there is no fix younger than TTL
+    def getCoordinates(self):
+        with self.lock:
+            if self.fix is not None and time.monotonic() - self.fix_time <= self.ttl:
+                return self.fix
+        return None
+
+    # Get GPS position -> check if GPS is working if not use the static fallback position
+    def getPosition(self):
+        gps_data = self.getCoordinates()
+        if gps_data is None:
+            return self.fallback
+
+        if gps_data["latitude"][4] == "0":
+            gps_lat = self.fallback[0]
+        else:
+            gps_lat = gps_data["latitude"]
+
+        if gps_data["longtitude"][4] == "0":
+            gps_long = self.fallback[1]
+        else:
+            gps_long = gps_data["longtitude"]
+        return gps_lat, gps_long
         
+# Disk spool of MQTT messages -> bounded number of append-only segment files, the oldest segment is dropped when full
+class Spool:
+    # Record header -> retain flag, topic length, payload length
+    RECORD = struct.Struct("<BHI")
+
+    def __init__(self, path, segment_size, segments):
+        self.path = path
+        self.segment_size = int(segment_size)
+        self.segments = int(segments)
+        os.makedirs(self.path, exist_ok=True)
+        # Record counts of segments from the oldest one -> segments left from the last run are replayed
+        self.counts = collections.OrderedDict()
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith(".seg"):
+                self.counts[int(name[:-4])] = self.countRecords(os.path.join(self.path, name))
+        self.records = sum(self.counts.values())
+        self.dropped = 0
+        self.writer = None
+        self.writer_seq = None
+        self.reader = None
+        self.reader_seq = None
+
+    def segmentName(self, seq):
+        return os.path.join(self.path, "%012d.seg" % seq)
+
+    # Count complete records in a segment file
+    def countRecords(self, filename):
+        count = 0
+        with open(filename, "rb") as segment:
+            while True:
+                header = segment.read(self.RECORD.size)
+                if len(header) < self.RECORD.size:
+                    break
+                retain, topic_length, payload_length = self.RECORD.unpack(header)
+                if len(segment.read(topic_length + payload_length)) < topic_length + payload_length:
+                    break
+                count += 1
+        return count
+
+    # Start a new segment and drop the oldest ones over the limit
+    def rotate(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.writer_seq = next(reversed(self.counts)) + 1 if len(self.counts) > 0 else 0
+        self.counts[self.writer_seq] = 0
+        self.writer = open(self.segmentName(self.writer_seq), "ab")
+        while len(self.counts) > self.segments:
+            seq, count = self.counts.popitem(last=False)
+            if seq == self.reader_seq:
+                self.reader.close()
+                self.reader = None
+                self.reader_seq = None
+            os.remove(self.segmentName(seq))
+            self.records -= count
+            self.dropped += count
+            # A segment which has been read completely holds no messages
+            if count > 0:
+                logging.warning("MQTT spool is full, the oldest " + str(count) + " messages have been dropped")
+
+    # Append a message
+    def put(self, topic, payload, retain):
+        if self.writer is None or self.writer.tell() >= self.segment_size:
+            self.rotate()
+        topic = topic.encode("utf-8")
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.writer.write(self.RECORD.pack(int(retain), len(topic), len(payload)) + topic + payload)
+        self.writer.flush()
+        self.counts[self.writer_seq] += 1
+        self.records += 1
+
+    # Take the oldest message -> None if the spool is empty
+    def get(self):
+        while self.records > 0:
+            if self.reader is None:
+                self.reader_seq = next(iter(self.counts))
+                self.reader = open(self.segmentName(self.reader_seq), "rb")
+            header = self.reader.read(self.RECORD.size)
+            if len(header) == self.RECORD.size:
+                retain, topic_length, payload_length = self.RECORD.unpack(header)
+                body = self.reader.read(topic_length + payload_length)
+                if len(body) == topic_length + payload_length:
+                    self.counts[self.reader_seq] -= 1
+                    self.records -= 1
+                    message = (body[:topic_length].decode("utf-8"), body[topic_length:], bool(retain))
+                    if self.records == 0:
+                        self.clear()
+                    return message
+            # End of a segment -> remove it and continue with the next one
+            self.reader.close()
+            self.reader = None
+            self.records -= self.counts[self.reader_seq]
+            if self.reader_seq == self.writer_seq:
+                self.writer.close()
+                self.writer = None
+            del self.counts[self.reader_seq]
+            os.remove(self.segmentName(self.reader_seq))
+            self.reader_seq = None
+        return None
+
+    # Remove all segments
+    def clear(self):
+        self.close()
+        for seq in self.counts:
+            os.remove(self.segmentName(seq))
+        self.counts.clear()
+        self.records = 0
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.reader is not None:
+            self.reader.close()
+        self.writer = None
+        self.writer_seq = None
+        self.reader = None
+        self.reader_seq = None
+
+# Outbound queue of MQTT messages -> messages are kept in memory and spilled to the disk spool when the memory part is full
+class OutboundQueue:
+    def __init__(self, memory_limit, spool):
+        self.memory = collections.deque()
+        self.memory_limit = int(memory_limit)
+        self.spool = spool
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.memory) + self.spool.records
+
+    # Add a message -> the oldest message in memory goes to the spool, so the spool always holds the oldest messages
+    def put(self, topic, payload, retain=False):
+        with self.lock:
+            self.memory.append((topic, payload, retain))
+            if len(self.memory) > self.memory_limit:
+                self.spool.put(*self.memory.popleft())
+
+    # Take the oldest message -> None if the queue is empty
+    def get(self):
+        with self.lock:
+            if self.spool.records > 0:
+                message = self.spool.get()
+                if message is not None:
+                    return message
+            if len(self.memory) > 0:
+                return self.memory.popleft()
+            return None
+
+    # Move unacknowledged and queued messages to the spool, so they are replayed after restart
+    def close(self, unacked=()):
+        with self.lock:
+            for message in unacked:
+                self.spool.put(*message)
+            while len(self.memory) > 0:
+                self.spool.put(*self.memory.popleft())
+            self.spool.close()
+
+# Append-only capture of acquisition results -> entries of a string table (tag names, statuses, roles) and frames of records
+class Capture:
+    MAGIC = b"OPCC"
+    # Entry -> type (S string, F frame) and payload length, an incomplete last entry is dropped
+    ENTRY = struct.Struct("<cI")
+    # Frame -> poll timestamp in ms, GPS position and number of records
+    FRAME = struct.Struct("<dddI")
+    # Record -> tag, status and role string indexes, source timestamp and type of the value
+    RECORD = struct.Struct("<IIIdB")
+    LENGTH = struct.Struct("<I")
+    FLOAT = struct.Struct("<d")
+    INT = struct.Struct("<q")
+    VALUE_NONE, VALUE_FLOAT, VALUE_INT, VALUE_BOOL, VALUE_JSON = range(5)
+    # Registers, aggregates and source timestamps other than numbers and 'n/a' are stored as JSON if they have a value
+    REGISTERS = ("register_min", "register_max", "register_timestamp")
+
+    def __init__(self, filename, max_size=104857600):
+        self.filename = filename
+        self.max_size = int(max_size)
+        self.file = None
+        self.strings = {}
+        self.size = 0
+        self.frames_written = 0
+
+    # Open the capture for appending -> the string table of an existing capture is loaded
+    def open(self):
+        directory = os.path.dirname(self.filename)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        self.strings = {}
+        end = len(self.MAGIC)
+        if os.path.exists(self.filename) and os.path.getsize(self.filename) > 0:
+            for entry_type, payload, end in self.entries():
+                if entry_type == b"S":
+                    self.strings[payload.decode("utf-8")] = len(self.strings)
+            self.file = open(self.filename, "r+b")
+            self.file.truncate(end)
+            self.file.seek(end)
+        else:
+            self.file = open(self.filename, "wb")
+            self.file.write(self.MAGIC)
+        self.size = end
+        logging.info("Capture file opened -> " + self.filename)
+
+    # Read complete entries -> (type, payload, end offset)
+    def entries(self):
+        with open(self.filename, "rb") as capture_file:
+            if capture_file.read(len(self.MAGIC)) != self.MAGIC:
+                raise Exception("File is not a capture -> " + self.filename)
+            end = len(self.MAGIC)
+            while True:
+                header = capture_file.read(self.ENTRY.size)
+                if len(header) < self.ENTRY.size:
+                    return
+                entry_type, length = self.ENTRY.unpack(header)
+                payload = capture_file.read(length)
+                if len(payload) < length:
+                    return
+                end += self.ENTRY.size + length
+                yield entry_type, payload, end
+
+    # Index of a string in the string table -> new strings are appended to the capture
+    def index(self, value, chunks):
+        value = str(value)
+        index = self.strings.get(value)
+        if index is None:
+            index = len(self.strings)
+            self.strings[value] = index
+            payload = value.encode("utf-8")
+            chunks.append(self.ENTRY.pack(b"S", len(payload)))
+            chunks.append(payload)
+        return index
+
+    # Append results of one poll cycle
+    def write(self, data, timestamp=None, position=(0.0, 0.0)):
+        if self.file is None:
+            self.open()
+        if timestamp is None:
+            timestamp = time.time()*1000
+        chunks = []
+        frame = [self.FRAME.pack(timestamp, float(position[0]), float(position[1]), len(data))]
+        for index in range(data.size):
+            value = data.values[index]
+            source_timestamp = data.source_timestamps[index]
+            numeric = isinstance(source_timestamp, (int, float)) and not isinstance(source_timestamp, bool)
+            frame.append(self.RECORD.pack(self.index(data.keys[index], chunks), self.index(data.statuses[index], chunks), self.index(data.roles[index], chunks),
+                                          source_timestamp if numeric else math.nan, self.valueType(value)))
+            frame.append(self.packValue(value))
+            extra = {}
+            if not numeric and source_timestamp != "n/a":
+                extra["source_timestamp"] = source_timestamp
+            for field, val in zip(self.REGISTERS, (data.register_mins[index], data.register_maxs[index], data.register_timestamps[index])):
+                if val != "n/a":
+                    extra[field] = val
+            if data.aggregates[index] is not None:
+                extra["aggregate"], extra["window_start"], extra["window_end"] = data.aggregates[index]
+            payload = json.dumps(extra, default=str).encode("utf-8") if len(extra) > 0 else b""
+            frame.append(self.LENGTH.pack(len(payload)))
+            frame.append(payload)
+        payload = b"".join(frame)
+        chunks.append(self.ENTRY.pack(b"F", len(payload)))
+        chunks.append(payload)
+        block = b"".join(chunks)
+        try:
+            self.file.write(block)
+            self.file.flush()
+        except Exception:
+            # The next write opens the capture again -> a partly written entry is dropped and the string table is loaded from the file
+            capture_file, self.file = self.file, None
+            try:
+                capture_file.close()
+            except Exception as e:
+                logging.debug("Unable to close the failed capture file -> " + str(e))
+            raise
+        self.size += len(block)
+        self.frames_written += 1
+        if self.size >= self.max_size:
+            self.rotate()
+
+    # Keep one previous capture file and start a new one
+    def rotate(self):
+        self.close()
+        os.replace(self.filename, self.filename + ".1")
+        logging.info("Capture file has been rotated -> " + self.filename + ".1")
+        self.open()
+
+    def valueType(self, value):
+        if value is None:
+            return self.VALUE_NONE
+        if isinstance(value, bool):
+            return self.VALUE_BOOL
+        if isinstance(value, float):
+            return self.VALUE_FLOAT
+        if isinstance(value, int) and -2**63 <= value < 2**63:
+            return self.VALUE_INT
+        return self.VALUE_JSON
+
+    def packValue(self, value):
+        value_type = self.valueType(value)
+        if value_type == self.VALUE_NONE:
+            return b""
+        if value_type == self.VALUE_BOOL:
+            return b"\x01" if value else b"\x00"
+        if value_type == self.VALUE_FLOAT:
+            return self.FLOAT.pack(value)
+        if value_type == self.VALUE_INT:
+            return self.INT.pack(value)
+        payload = json.dumps(value, default=str).encode("utf-8")
+        return self.LENGTH.pack(len(payload)) + payload
+
+    # Read captured frames -> (timestamp, (latitude, longitude), frame) in the order of capture
+    def frames(self):
+        strings = []
+        for entry_type, payload, end in self.entries():
+            if entry_type == b"S":
+                strings.append(payload.decode("utf-8"))
+                continue
+            timestamp, latitude, longitude, count = self.FRAME.unpack_from(payload, 0)
+            offset = self.FRAME.size
+            data = Frame(count)
+            for index in range(count):
+                key, status, role, source_timestamp, value_type = self.RECORD.unpack_from(payload, offset)
+                offset += self.RECORD.size
+                if value_type == self.VALUE_NONE:
+                    value = None
+                elif value_type == self.VALUE_BOOL:
+                    value = payload[offset] == 1
+                    offset += 1
+                elif value_type == self.VALUE_FLOAT:
+                    value = self.FLOAT.unpack_from(payload, offset)[0]
+                    offset += self.FLOAT.size
+                elif value_type == self.VALUE_INT:
+                    value = self.INT.unpack_from(payload, offset)[0]
+                    offset += self.INT.size
+                else:
+                    length = self.LENGTH.unpack_from(payload, offset)[0]
+                    value = json.loads(payload[offset+self.LENGTH.size:offset+self.LENGTH.size+length].decode("utf-8"))
+                    offset += self.LENGTH.size + length
+                extra = {}
+                length = self.LENGTH.unpack_from(payload, offset)[0]
+                if length > 0:
+                    extra = json.loads(payload[offset+self.LENGTH.size:offset+self.LENGTH.size+length].decode("utf-8"))
+                offset += self.LENGTH.size + length
+                aggregate = (extra["aggregate"], extra["window_start"], extra["window_end"]) if "aggregate" in extra else None
+                if math.isnan(source_timestamp):
+                    source_timestamp = extra.get("source_timestamp", "n/a")
+                data.append(strings[key], value, strings[status], source_timestamp, strings[role],
+                            extra.get("register_min","n/a"), extra.get("register_max","n/a"), extra.get("register_timestamp","n/a"), aggregate)
+            yield timestamp, (latitude, longitude), data
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
 # Handles all activites around MQTT 
 class MqttClient:
-    def __init__(self, broker,port,topic,snmp_client):
+    # Record fields sent in the batch mode, the order is announced in the schema message
+    FIELDS = ["value", "status", "source_timestamp", "role", "register_min", "register_max", "register_timestamp", "aggregate", "window_start", "window_end"]
+
+    def __init__(self, broker,port,topic,snmp_client,publish_mode="tag",encoding="str",outbox=None,replay_rate=100,max_inflight=20,reconnect_delay=1,reconnect_max_delay=60):
         self.broker = str(broker)
         self.topic = str(topic)
         self.port = int(port)
         self.mqtt_client = mqtt.Client(client_id="iox-app", clean_session=False)
         self.snmp_client = snmp_client
-        #self.mqtt_client.on_connect = self.on_connect
+        self.mqtt_client.on_connect = self.on_connect
+        self.mqtt_client.on_disconnect = self.on_disconnect
         self.mqtt_client.on_message = self.on_message
+        # The network loop reconnects to the broker with an exponential backoff
+        self.mqtt_client.reconnect_delay_set(min_delay=max(int(float(reconnect_delay)), 1), max_delay=max(int(float(reconnect_max_delay)), 1))
         self.control = None
+        self.connected = False
+        self.was_connected = False
+        # Publish mode -> tag (one message per variable) or batch (one message per poll cycle)
+        self.publish_mode = publish_mode
+        # Payload encoding -> str, json, msgpack or cbor
+        self.encoding = encoding
+        # Tag index dictionary for the batch mode
+        self.tag_index = {}
+        self.schema_sent = False
+        # Store and forward queue -> None publishes directly with QoS 0
+        self.outbox = outbox
+        # Rate limit of the backlog replay in messages per second -> 0 is unlimited
+        self.replay_rate = float(replay_rate)
+        self.replaying = False
+        # Unacknowledged messages published with QoS 1 -> {mid: message}
+        self.max_inflight = int(max_inflight)
+        self.mqtt_client.max_inflight_messages_set(self.max_inflight)
+        self.inflight = {}
+        # Acks received while the forwarder publishes a message -> the broker may answer before the mid is known
+        self.publishing = False
+        self.early_acks = set()
+        self.acked = 0
+        self.pending = None
+        self.lock = threading.Lock()
+        self.outbox_event = threading.Event()
+        self.forwarder = None
+        self.forwarding = False
+        self.metrics = Metrics()
+        self.metrics.register("mqtt_acked", "counter", lambda: self.acked)
+        self.metrics.register("mqtt_inflight", "gauge", lambda: len(self.inflight))
+        # Acks are tracked only for messages of the store and forward queue
+        if self.outbox is not None:
+            self.mqtt_client.on_publish = self.on_publish
+            self.metrics.register("outbox_depth", "gauge", lambda: len(self.outbox))
+            self.metrics.register("spool_dropped", "counter", lambda: self.outbox.spool.dropped)
 
-    # Login to the MQTT broker
+    # Login to the MQTT broker -> the connection is established by the network loop, which also retries it if the broker is not available
     def login(self):
         try:
-            self.mqtt_client.connect(host=self.broker,port=int(self.port),keepalive=60)
+            self.mqtt_client.connect_async(host=self.broker,port=int(self.port),keepalive=60)
             self.control = Control()
+            self.snmp_client.start()
         except Exception as e:
             raise Exception("MQTT broker is not available. Please check connectivity by cmd tools")
-        logging.info("MQTT client is connected to the broker" + self.broker)
+        logging.info("MQTT client is connecting to the broker" + self.broker)
+        if self.outbox is not None and not self.forwarding:
+            self.forwarding = True
+            self.forwarder = threading.Thread(target=self.forward, name="mqtt-forwarder", daemon=True)
+            self.forwarder.start()
+        # Announce the tag index dictionary with the first frame of the session
+        self.schema_sent = False
     
     # Logout from the MQTT broker 
     def logout(self):
+        if self.forwarding:
+            self.forwarding = False
+            self.outbox_event.set()
+            self.forwarder.join()
+            with self.lock:
+                unacked = list(self.inflight.values())
+                self.inflight.clear()
+            if self.pending is not None:
+                unacked.append(self.pending)
+                self.pending = None
+            self.outbox.close(unacked)
         self.mqtt_client.disconnect()
+        self.snmp_client.stop()
         logging.info("MQTT client is disconnected from the broker" + self.broker)
 
+    # Connection to the broker has been established
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logging.error("MQTT connection has been refused -> " + mqtt.connack_string(rc))
+            return
+        if self.was_connected:
+            self.metrics.inc("mqtt_reconnects")
+            logging.info("MQTT connection to the broker has been restored")
+        self.connected = True
+        self.was_connected = True
+        # Subscriptions and the retained schema are renewed in every session -> the broker may have lost them
+        self.mqtt_client.subscribe(self.topic+"command")
+        self.schema_sent = False
+        # Replay the backlog with the rate limit
+        if self.outbox is not None and len(self.outbox) > 0:
+            self.replaying = True
+            logging.info("MQTT backlog of " + str(len(self.outbox)) + " messages will be replayed")
+        self.outbox_event.set()
+
+    # Connection to the broker has been lost
+    def on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if rc != 0:
+            logging.warning("MQTT connection has been lost -> " + mqtt.error_string(rc))
+
+    # Message has been acknowledged by the broker -> other messages than forwarded ones are ignored
+    def on_publish(self, client, userdata, mid):
+        with self.lock:
+            if mid in self.inflight:
+                del self.inflight[mid]
+            elif self.publishing:
+                self.early_acks.add(mid)
+                return
+            else:
+                return
+            self.acked += 1
+        self.outbox_event.set()
+
+    # Publish a message -> directly or via the store and forward queue
+    def publish(self, topic, payload, qos=0, retain=False):
+        if self.outbox is None:
+            return self.mqtt_client.publish(topic,payload=payload, qos=qos, retain=retain)
+        self.outbox.put(topic, payload, retain)
+        self.outbox_event.set()
+
+    # Forward queued messages with QoS 1 while the broker is connected
+    def forward(self):
+        tokens = 0
+        last = time.monotonic()
+        while self.forwarding:
+            self.outbox_event.wait(0.1)
+            self.outbox_event.clear()
+            now = time.monotonic()
+            tokens = min(tokens + (now - last)*self.replay_rate, max(self.replay_rate, 1))
+            last = now
+            while self.connected and self.forwarding and len(self.inflight) < self.max_inflight:
+                if self.replaying and self.replay_rate > 0 and tokens < 1:
+                    break
+                message = self.pending or self.outbox.get()
+                if message is None:
+                    if self.replaying:
+                        self.replaying = False
+                        logging.info("MQTT backlog has been replayed")
+                    break
+                topic, payload, retain = message
+                # Early acks are valid only for this publish -> a kept mid could match a message after the mid wraparound
+                with self.lock:
+                    self.publishing = True
+                try:
+                    info = self.mqtt_client.publish(topic,payload=payload, qos=1, retain=retain)
+                    # Not connected messages are kept and resent by the MQTT client itself
+                    if info.rc in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                        with self.lock:
+                            if info.mid in self.early_acks:
+                                self.acked += 1
+                            else:
+                                self.inflight[info.mid] = message
+                finally:
+                    with self.lock:
+                        self.publishing = False
+                        self.early_acks.clear()
+                if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                    self.pending = message
+                    break
+                self.pending = None
+                tokens -= 1
+
     # Process received message - commands
     def on_message(self,client, data, msg):
-        payload_data = json.loads(str(msg.payload.decode()))
+        # Errors of commands are only logged -> an exception would stop the network loop of the MQTT client and its reconnects
+        try:
+            payload_data = json.loads(msg.payload.decode())
+            if not isinstance(payload_data, dict):
+                raise Exception("Command must be a JSON object")
+        except Exception as e:
+            logging.error("Invalid command from MQTT -> " + str(e))
+            return
         for cmd_key, cmd_val in payload_data.items():
-            if cmd_key == "poll":
-                self.control.poll_interval = cmd_val
-                logging.info("Received command from the server: "+cmd_key+":"+cmd_val)
-            elif cmd_key == "clear":
-                self.control.opc_client.clearRegister(cmd_val)
-                logging.info("Received command from the server: "+cmd_key+":"+cmd_val)
-            elif cmd_key == "getData":
-                data = self.control.opc_client.getStoredData(cmd_val)
-                logging.info("Received command from the server: "+cmd_key+":"+cmd_val)
-                self.mqtt_client.publish(self.topic+cmd_val+"/storedData",payload=str(data), qos=0, retain=False)
-                logging.info("Command reply sent back: ")
-            else:
-                logging.error("Unknown command from MQTT")
+            try:
+                self.runCommand(cmd_key, cmd_val)
+            except Exception as e:
+                logging.error("Unable to process command " + cmd_key + " from MQTT -> " + str(e))
+
+    # Run one command received from the server
+    def runCommand(self, cmd_key, cmd_val):
+        if cmd_key == "poll":
+            # Only a positive finite interval is applied -> zero or negative intervals would stop the acquisition loop
+            try:
+                interval = float(cmd_val)
+            except (TypeError, ValueError):
+                interval = 0
+            if not 0 < interval < float("inf"):
+                raise Exception("Invalid poll interval -> " + str(cmd_val))
+            self.control.poll_interval = interval
+            logging.info("Received command from the server: "+cmd_key+":"+str(cmd_val))
+        elif cmd_key == "clear":
+            opc_client = self.control.getClient(cmd_val) if isinstance(cmd_val, str) else None
+            if opc_client is None or cmd_val not in opc_client.variables:
+                raise Exception("Unknown variable -> " + str(cmd_val))
+            opc_client.clearRegister(cmd_val)
+            logging.info("Received command from the server: "+cmd_key+":"+cmd_val)
+        elif cmd_key == "reload":
+            # Applied by the acquisition loop between two cycles
+            self.control.reload_requested = True
+            logging.info("Received command from the server: "+cmd_key)
+        elif cmd_key == "getData" and isinstance(cmd_val, dict):
+            logging.info("Received command from the server: "+cmd_key+":"+json.dumps(cmd_val))
+            self.sendHistory(cmd_val)
+        elif cmd_key == "getData":
+            if not isinstance(cmd_val, str):
+                raise Exception("Variable name or history query expected -> " + str(cmd_val))
+            data = self.control.getClient(cmd_val).getStoredData(cmd_val)
+            logging.info("Received command from the server: "+cmd_key+":"+cmd_val)
+            self.mqtt_client.publish(self.topic+cmd_val+"/storedData",payload=json.dumps(data), qos=0, retain=False)
+            logging.info("Command reply sent back: ")
+        else:
+            raise Exception("Unknown command")
+
+    # Answer a history query -> downsampled points in pages, zlib compressed JSON unless disabled
+    def sendHistory(self, request):
+        key = str(request.get("key"))
+        try:
+            query = HistoryQuery(request)
+            points = self.control.getClient(query.key).getStoredData(query.key, query.start, query.end)
+            if points is None:
+                raise Exception("No history is stored for " + query.key)
+        except Exception as e:
+            logging.error("Unable to answer the history query -> " + str(e))
+            reply = {"id": request.get("id"), "key": key, "error": str(e)}
+            self.mqtt_client.publish(self.topic+key+"/storedData",payload=json.dumps(reply), qos=0, retain=False)
+            return
+        sampled = query.downsample(points)
+        pages = query.pages(sampled)
+        for number, page in enumerate(pages):
+            reply = {"id": query.id, "key": query.key, "page": number, "pages": len(pages), "total": len(points),
+                     "method": query.method if len(sampled) < len(points) else None, "points": page}
+            payload = json.dumps(reply)
+            if query.compress:
+                payload = zlib.compress(payload.encode("utf-8"))
+            self.mqtt_client.publish(self.topic+query.key+"/storedData",payload=payload, qos=0, retain=False)
+        logging.info("History reply sent back -> " + str(len(sampled)) + " points in " + str(len(pages)) + " pages")
+
+    # Encode payload by the configured encoding
+    def encode(self, payload):
+        if self.encoding == "json":
+            return json.dumps(payload, default=str)
+        elif self.encoding == "msgpack":
+            return msgpack.packb(payload, default=str)
+        elif self.encoding == "cbor":
+            return cbor2.dumps(payload, default=lambda encoder, value: encoder.encode(str(value)))
+        return str(payload)
+
+    # Publish the tag index dictionary used by the batch mode frames
+    def sendSchema(self):
+        tags = sorted(self.tag_index, key=self.tag_index.get)
+        schema = {"tags": tags, "fields": self.FIELDS}
+        self.publish(self.topic+"schema",payload=self.encode(schema), qos=1, retain=True)
+        self.schema_sent = True
+        logging.info("MQTT schema has been sent for " + str(len(tags)) + " variables")
+
+    # Send all variables of one poll cycle in one frame with a shared timestamp and GPS header
+    def sendFrame(self, data, timestamp, gps_lat, gps_long):
+        for record_key in data:
+            if record_key not in self.tag_index:
+                self.tag_index[record_key] = len(self.tag_index)
+                self.schema_sent = False
+        if not self.schema_sent:
+            self.sendSchema()
+
+        if self.encoding in ("msgpack", "cbor"):
+            # Compact frame -> rows of [tag index, fields...] with None instead of 'n/a', rows are taken from the frame lists directly
+            rows = []
+            for index in range(data.size):
+                aggregate = data.aggregates[index]
+                row = [self.tag_index[data.keys[index]], data.values[index], data.statuses[index], data.source_timestamps[index],
+                       data.roles[index], data.register_mins[index], data.register_maxs[index], data.register_timestamps[index]]
+                row.extend(aggregate if aggregate is not None else (None, None, None))
+                rows.append([None if value == "n/a" else value for value in row])
+            frame = {"t": timestamp, "g": [gps_lat, gps_long], "d": rows}
+        else:
+            frame = {"timestamp": timestamp, "gps_lat": gps_lat, "gps_long": gps_long, "tags": dict(data.items())}
+        self.publish(self.topic+"data",payload=self.encode(frame), qos=0, retain=False)
+
+    # Send pipeline statistics to the broker
+    def sendStats(self, stats):
+        self.publish(self.topic+"stats",payload=json.dumps(stats, default=str), qos=0, retain=False)
 
     # Send MQTT data to the broker
-    def sendData(self,data):
+    def sendData(self,data,timestamp=None,position=None):
+        with self.metrics.time("publish"):
+            self.sendRecords(data,timestamp,position)
+
+    # Encode and publish data records -> timestamp and position are given for replayed data
+    def sendRecords(self,data,timestamp=None,position=None):
         # Add GPS 
-        gps_data = self.snmp_client.getCoordinates()
-        # Prepare data records for each OPC/UA variable
-        for record_key, record_val in data.items():
-            # Add timestamp in ms
-            # NOTE: Maybe it is better to use time from GPS
-            record_val["timestamp"] = time.time()*1000
-            # Latitude - check if GPS is working if not add the static value -> Charles Square, Prague, CZE
-            if gps_data["latitude"][4] == "0":
-                record_val["gps_lat"] = 50.0754072
-            else:
-                record_val["gps_lat"] = gps_data["latitude"]
+        gps_lat, gps_long = position if position is not None else self.snmp_client.getPosition()
+        # Add timestamp in ms
+        # NOTE: Maybe it is better to use time from GPS
+        if timestamp is None:
+            timestamp = time.time()*1000
+        if self.publish_mode == "batch":
+            if len(data) > 0:
+                self.sendFrame(data, timestamp, gps_lat, gps_long)
+            return
 
-            # Longtitude - check if GPS is working if not add the static value -> Charles Square, Prague, CZE
-            if gps_data["longtitude"][4] == "0":
-                record_val["gps_long"] = 14.4165971
-            else:
-                record_val["gps_long"] = gps_data["longtitude"]
-            
-                
-            ret = self.mqtt_client.publish(self.topic+record_key,payload=str(record_val), qos=0, retain=False)
+        # Prepare data records for each OPC/UA variable -> a message needs its own dictionary
+        for record_key, record_val in data.items():
+            record_val["timestamp"] = timestamp
+            record_val["gps_lat"] = gps_lat
+            record_val["gps_long"] = gps_long
+            self.publish(self.topic+record_key,payload=self.encode(record_val), qos=0, retain=False)
 
     # Subscribe to MQTT to receive commands
+    # Start the network loop -> the command topic is subscribed when the connection is established
     def subscribe(self):
         try:
-            self.mqtt_client.subscribe(self.topic+"command")
             self.mqtt_client.loop_start()
         except Exception as e:
             raise Exception("Unable to subscribe topic",self.topic+"command")
@@ -342,13 +2068,13 @@ class Config:
     def getGeneral(self):
         try:
             general = self.config["general"]
-            # Test polling to int
+            # Test polling to number -> sub-second intervals are allowed
             tmp = general["polling"]
-            int(tmp)
+            float(tmp)
             
-            # Test polling to int
+            # Test polling to number
             tmp = general["polling_change"]
-            int(tmp)
+            float(tmp)
 
             # Simple test to ip address
             tmp = general["mqtt_broker"]
@@ -369,18 +2095,125 @@ class Config:
             if tmp[-1] != "/":
                 raise Exception("Topic name must end with '/'")
 
+            # Optional acquisition mode
+            tmp = general.get("mode","poll")
+            if tmp not in ("poll","batch","subscribe"):
+                raise Exception("Acquisition mode must be 'poll', 'batch' or 'subscribe'")
+
+            # Optional subscribe mode parameters
+            float(general.get("sampling_interval","500"))
+            int(general.get("queue_size","1"))
+            float(general.get("subscribe_deadband","0"))
+
+            # Optional MQTT publish mode and payload encoding
+            tmp = general.get("publish_mode","tag")
+            if tmp not in ("tag","batch"):
+                raise Exception("Publish mode must be 'tag' or 'batch'")
+            tmp = general.get("encoding","str")
+            if tmp not in ("str","json","msgpack","cbor"):
+                raise Exception("Encoding must be 'str', 'json', 'msgpack' or 'cbor'")
+            if (tmp == "msgpack" and msgpack is None) or (tmp == "cbor" and cbor2 is None):
+                raise Exception("Python module for the " + tmp + " encoding is not installed")
+
+            # Optional GPS sampler parameters
+            float(general.get("gps_refresh","10"))
+            float(general.get("gps_ttl","60"))
+            tmp = general.get("gps_fallback","50.0754072,14.4165971")
+            if len(tmp.split(",")) != 2:
+                raise Exception("GPS fallback must be in format 'latitude,longtitude'")
+
+            # Optional pipeline parameters
+            int(general.get("publish_queue","10"))
+            float(general.get("stats_interval","60"))
+
+            # Optional metrics parameters
+            if general.get("publish_stats","True") not in ("True","False"):
+                raise Exception("Publish stats must be 'True' or 'False'")
+            int(general.get("metrics_port","0"))
+
+            # Optional reconnect backoff in seconds
+            if float(general.get("reconnect_delay","1")) <= 0 or float(general.get("reconnect_max_delay","60")) < float(general.get("reconnect_delay","1")):
+                raise Exception("Reconnect delay must be positive and not greater than the max reconnect delay")
+
+            # Optional interval of configuration file checks in seconds -> 0 disables the watcher
+            float(general.get("config_watch","0"))
+
+            # Optional capture of acquisition results
+            if general.get("capture","False") not in ("True","False"):
+                raise Exception("Capture must be 'True' or 'False'")
+            int(general.get("capture_max_size","104857600"))
+
+            # Optional node cache
+            if general.get("node_cache","True") not in ("True","False"):
+                raise Exception("Node cache must be 'True' or 'False'")
+
+            # Optional store and forward parameters
+            if general.get("store_forward","False") not in ("True","False"):
+                raise Exception("Store and forward must be 'True' or 'False'")
+            int(general.get("outbox_memory","1000"))
+            int(general.get("spool_segment_size","1048576"))
+            int(general.get("spool_segments","64"))
+            float(general.get("replay_rate","100"))
+            int(general.get("max_inflight","20"))
+
         except Exception as e:
             logging.error("Missing mandatory General section or General parameters in     the configuration file or parameters are not formated well -> "+ str(e))
     
             
         return general
    
+    # Get additional OPC/UA server sections -> [server:name], acquisition parameters default to the general section
+    def getServers(self):
+        servers = {}
+        general = self.config["general"]
+        for section in self.config.sections():
+            if not section.startswith("server:"):
+                continue
+            name = section.split(":",1)[1]
+            server = {}
+            for key in ("opc_server","mode","sampling_interval","queue_size","subscribe_deadband"):
+                server[key] = self.config[section].get(key, general.get(key))
+            try:
+                if server["opc_server"] is None or server["opc_server"].split("@")[0] != "opc.tcp://":
+                    raise Exception("OPC server address must start with 'opc.tcp://'")
+                if server["mode"] not in (None,"poll","batch","subscribe"):
+                    raise Exception("Acquisition mode must be 'poll', 'batch' or 'subscribe'")
+                if not self.config.has_section("variables:"+name):
+                    raise Exception("Missing variables section 'variables:"+name+"'")
+            except Exception as e:
+                logging.error("Server section " + section + " is not formated well -> " + str(e))
+                continue
+            servers[name] = server
+        return servers
+
+    # Get scan class sections -> [scan:name] with rate, idle_rate and state parameters
+    def getScanClasses(self):
+        scan_classes = {}
+        for section in self.config.sections():
+            if not section.startswith("scan:"):
+                continue
+            name = section.split(":",1)[1]
+            try:
+                rate = parseDuration(self.config[section]["rate"])
+                idle_rate = parseDuration(self.config[section].get("idle_rate", self.config[section]["rate"]))
+                if rate <= 0 or idle_rate <= 0:
+                    raise Exception("Rates must be positive")
+                states = [state.strip() for state in self.config[section].get("state","").split(",") if state.strip() != ""]
+            except Exception as e:
+                raise Exception("Scan class section " + section + " is not formated well -> " + str(e))
+            scan_classes[name] = ScanClass(name, rate, idle_rate, states)
+        return scan_classes
+
     # TODO: Test that strings are without quotes 
-    # Get the variables section
-    def getOpcVariables(self):
+    # Get the variables section -> variables of additional servers are prefixed with the server name
+    def getOpcVariables(self, server=None):
         variables = {}
-        for key, val in self.config["variables"].items():
-            variables[key] = val 
+        if server is None:
+            for key, val in self.config["variables"].items():
+                variables[key] = val 
+        else:
+            for key, val in self.config["variables:"+server].items():
+                variables[server+"/"+key] = val
         return variables
     
     # Get custom variables settings section
@@ -392,6 +2225,9 @@ class Config:
         sections.remove("variables")
 
         for section in sections:
+            # Skip sections of additional servers and scan classes
+            if section.startswith("server:") or section.startswith("variables:") or section.startswith("scan:"):
+                continue
             for key,val in self.config[section].items():
                 try:    
                     settings[section][key] = val 
@@ -409,15 +2245,181 @@ class Singleton(type):
             cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
 
+# Time measurement of one pipeline stage
+class StageTimer:
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        if exc_type is not None:
+            self.metrics.inc(self.stage + "_errors")
+        return False
+
+# Metrics of the processing pipeline -> stage duration histograms, counters and gauges
+class Metrics(metaclass=Singleton):
+    # Histogram buckets in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    PREFIX = "opc_plugin_"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Stage histograms -> {stage: [count per bucket..., count over the last bucket, sum]}
+        self.histograms = {}
+        self.counters = collections.defaultdict(int)
+        # Values owned by other objects -> {name: (kind, callable)}
+        self.callbacks = {}
+        self.server = None
+
+    # Measure duration of a stage
+    def time(self, stage):
+        return StageTimer(self, stage)
+
+    # Add a stage duration in seconds
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = [0]*(len(self.BUCKETS) + 1) + [0.0]
+                self.histograms[stage] = histogram
+            histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    # Increment a counter
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    # Register a counter or a gauge read from a callable
+    def register(self, name, kind, callback):
+        self.callbacks[name] = (kind, callback)
+
+    # Read registered values
+    def readCallbacks(self):
+        values = {}
+        for name, (kind, callback) in list(self.callbacks.items()):
+            try:
+                values[name] = (kind, callback())
+            except Exception as e:
+                logging.debug("Unable to read metric " + name + " -> " + str(e))
+        return values
+
+    # Render metrics in the Prometheus text format
+    def render(self):
+        lines = ["# TYPE " + self.PREFIX + "stage_seconds histogram"]
+        with self.lock:
+            histograms = {stage: list(histogram) for stage, histogram in self.histograms.items()}
+            counters = dict(self.counters)
+        for stage, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), histogram):
+                cumulative += count
+                lines.append(self.PREFIX + "stage_seconds_bucket{stage=\"" + stage + "\",le=\"" + str(bound) + "\"} " + str(cumulative))
+            lines.append(self.PREFIX + "stage_seconds_sum{stage=\"" + stage + "\"} " + str(histogram[-1]))
+            lines.append(self.PREFIX + "stage_seconds_count{stage=\"" + stage + "\"} " + str(cumulative))
+        for name, value in sorted(counters.items()):
+            lines.append("# TYPE " + self.PREFIX + name + "_total counter")
+            lines.append(self.PREFIX + name + "_total " + str(value))
+        for name, (kind, value) in sorted(self.readCallbacks().items()):
+            suffix = "_total" if kind == "counter" else ""
+            lines.append("# TYPE " + self.PREFIX + name + suffix + " " + kind)
+            lines.append(self.PREFIX + name + suffix + " " + str(value))
+        return "\n".join(lines) + "\n"
+
+    # Summary of metrics for the stats message
+    def snapshot(self):
+        stages = {}
+        with self.lock:
+            for stage, histogram in self.histograms.items():
+                count = sum(histogram[:-1])
+                stages[stage] = {"count": count, "avg_ms": histogram[-1]/count*1000 if count > 0 else 0}
+            counters = dict(self.counters)
+        for name, (kind, value) in self.readCallbacks().items():
+            counters[name] = value
+        return {"timestamp": time.time()*1000, "stages": stages, "counters": counters}
+
+    # Start the HTTP endpoint with metrics in the Prometheus text format
+    def serve(self, port):
+        self.server = MetricsServer(("", int(port)), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        logging.info("Metrics endpoint is listening on port " + str(port))
+
+# HTTP server of the metrics endpoint -> one thread per request, http.server.ThreadingHTTPServer is missing in Python 3.6
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+# HTTP handler of the metrics endpoint
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = Metrics().render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Access log is not needed
+    def log_message(self, format, *args):
+        pass
+
 # The main class to control the whole flow
 class Control(metaclass=Singleton):
-    def __init__(self, poll_interval=5, poll_change=1, opc_client=None, mqtt_client=None):
-        self.poll_interval = int(poll_interval) 
-        self.poll_change = int(poll_change)
-        self.poll_normal = int(poll_interval)
+    def __init__(self, poll_interval=5, poll_change=1, opc_client=None, mqtt_client=None, queue_size=10, stats_interval=60, opc_clients=None, publish_stats="True", scan_classes=None, config_file=None, config_watch=0, capture=None):
+        self.poll_interval = float(poll_interval) 
+        self.poll_change = float(poll_change)
+        self.poll_normal = float(poll_interval)
         self.ready_flag = True
         self.opc_client = opc_client
         self.mqtt_client = mqtt_client
+        # All OPC/UA clients -> the first one is the primary server from the general section
+        self.opc_clients = opc_clients if opc_clients is not None else [opc_client]
+        self.executor = None
+        # Scan classes -> the default one follows the polling interval
+        self.scan_classes = {ScanClass.DEFAULT: ScanClass(ScanClass.DEFAULT)}
+        if scan_classes is not None:
+            self.scan_classes.update(scan_classes)
+        # The last values of status variables
+        self.states = {}
+        # Bounded queue between the acquisition and the publish stage
+        self.queue = queue.Queue(maxsize=int(queue_size))
+        # Frames of poll cycles returned by the publish stage -> reused, so memory stays flat
+        self.frames = collections.deque()
+        self.publisher = None
+        # Pipeline counters
+        self.ticks = 0
+        self.overruns = 0
+        self.missed_ticks = 0
+        self.dropped = 0
+        # Interval of pipeline statistics reports in seconds
+        self.stats_interval = float(stats_interval)
+        # Send statistics to the stats MQTT topic
+        self.publish_stats = publish_stats
+        self.metrics = Metrics()
+        self.metrics.register("ticks", "counter", lambda: self.ticks)
+        self.metrics.register("overruns", "counter", lambda: self.overruns)
+        self.metrics.register("missed_ticks", "counter", lambda: self.missed_ticks)
+        self.metrics.register("dropped", "counter", lambda: self.dropped)
+        self.metrics.register("publish_queue_depth", "gauge", lambda: self.queue.qsize())
+        # Configuration file for reloads -> reloaded by the reload command or when the file changes if watched
+        self.config_file = config_file
+        self.config_watch = float(config_watch)
+        self.config_mtime = None
+        self.next_watch = 0
+        self.reload_requested = False
+        # Capture of acquisition results for a later replay
+        self.capture = capture
+        if self.config_file is not None and self.config_watch > 0:
+            try:
+                self.config_mtime = os.stat(self.config_file).st_mtime
+            except OSError as e:
+                logging.warning("Unable to watch the configuration file -> " + str(e))
 
     # Change polling interval based on the configuration file
     def changePollInterval(self):
@@ -427,11 +2429,150 @@ class Control(metaclass=Singleton):
     def resetPollInterval(self):
         self.poll_interval = self.poll_normal
 
-    # Start remote connections 
-    def start(self):
+    # New value of a status variable -> status variables of scan classes switch only their scan class
+    def updateState(self, key, val):
+        self.states[key] = val
+        for scan_class in self.scan_classes.values():
+            if key in scan_class.states:
+                return
+        if val == 0:
+            # Process have stopped => reset/slow down polling interval
+            self.resetPollInterval()
+        else:
+            # Process have started => change/speed up polling interval
+            self.changePollInterval()
+
+    # Check that variables refer to defined scan classes and scan classes to status variables -> running ones by default
+    def checkScanClasses(self, plans=None, scan_classes=None):
+        if plans is None:
+            plans = {}
+            for opc_client in self.opc_clients:
+                plans.update(opc_client.plans)
+        if scan_classes is None:
+            scan_classes = self.scan_classes
+        roles = {}
+        for key, plan in plans.items():
+            roles[key] = plan.role
+            if plan.scan_class not in scan_classes:
+                raise Exception("Variable " + key + " refers to unknown scan class " + plan.scan_class)
+        for scan_class in scan_classes.values():
+            for state in scan_class.states:
+                if roles.get(state) != "status":
+                    raise Exception("State " + state + " of scan class " + scan_class.name + " must be a variable with the state parameter")
+
+    # Check if the watched configuration file has changed
+    def configChanged(self, now):
+        if self.config_file is None or self.config_watch <= 0 or now < self.next_watch:
+            return False
+        self.next_watch = now + self.config_watch
+        try:
+            mtime = os.stat(self.config_file).st_mtime
+        except OSError as e:
+            logging.warning("Unable to watch the configuration file -> " + str(e))
+            return False
+        if mtime == self.config_mtime:
+            return False
+        self.config_mtime = mtime
+        return True
+
+    # Reload the configuration file and apply changes of polling, scan classes and variables -> connections are kept
+    def reload(self):
+        try:
+            params = Config(self.config_file)
+            general = params.getGeneral()
+            poll_normal = float(general["polling"])
+            poll_change = float(general["polling_change"])
+            scan_classes = params.getScanClasses()
+            scan_classes[ScanClass.DEFAULT] = self.scan_classes[ScanClass.DEFAULT]
+            settings = params.getOpcVariablesSettings()
+            # Variables of running OPC/UA clients -> servers are matched by their address
+            configs = [(self.opc_client, params.getOpcVariables())]
+            for name, server in params.getServers().items():
+                opc_client = next((opc_client for opc_client in self.opc_clients if opc_client is not self.opc_client and opc_client.opc_url == server["opc_server"]), None)
+                if opc_client is None:
+                    logging.warning("New OPC/UA server " + name + " is used only after restart")
+                    continue
+                configs.append((opc_client, params.getOpcVariables(name)))
+            # Validate all plans before the running configuration is changed
+            plans = {}
+            for opc_client, variables in configs:
+                for key in variables:
+                    plans[key] = TagPlan(key, settings.get(key, {}))
+            self.checkScanClasses(plans, scan_classes)
+        except Exception as e:
+            logging.error("Configuration has not been reloaded -> " + str(e))
+            return False
+
+        # Polling interval follows the new configuration unless it was set by the poll command
+        if self.poll_interval == self.poll_normal:
+            self.poll_interval = poll_normal
+        elif self.poll_interval == self.poll_change:
+            self.poll_interval = poll_change
+        self.poll_normal = poll_normal
+        self.poll_change = poll_change
+        # Scan classes keep their schedule, new ones are read immediately
+        now = time.monotonic()
+        for name, scan_class in scan_classes.items():
+            scan_class.next_tick = self.scan_classes[name].next_tick if name in self.scan_classes else now
+            scan_class.interval = self.scan_classes[name].interval if name in self.scan_classes else None
+        self.scan_classes = scan_classes
+        for opc_client, variables in configs:
+            opc_client.reconfigure(variables, settings)
+        logging.info("Configuration has been reloaded from " + self.config_file)
+        return True
+
+    # Find OPC/UA client which reads the variable
+    def getClient(self, key):
+        for opc_client in self.opc_clients:
+            if key in opc_client.variables:
+                return opc_client
+        return self.opc_client
+
+    # Take a frame for a new poll cycle
+    def getFrame(self):
+        try:
+            frame = self.frames.pop()
+        except IndexError:
+            frame = Frame()
+        frame.clear()
+        return frame
+
+    # Return a published or dropped frame for reuse
+    def releaseFrame(self, frame):
+        self.frames.append(frame)
+
+    # Read data of scan classes from all OPC/UA servers -> connected servers are polled in parallel, each one to its own frame
+    def pollData(self, scan_classes=None):
+        data = self.getFrame()
+        if len(self.opc_clients) == 1:
+            return self.opc_client.pollData(scan_classes, data)
+        # Servers which are logging in are skipped -> the cycle never waits for a login
+        opc_clients = [opc_client for opc_client in self.opc_clients if opc_client.connected]
+        if len(opc_clients) == 0:
+            return data
+        frames = [data] + [self.getFrame() for opc_client in opc_clients[1:]]
+        list(self.executor.map(lambda pair: pair[0].pollData(scan_classes, pair[1]), zip(opc_clients, frames)))
+        for frame in frames[1:]:
+            data.extend(frame)
+            self.releaseFrame(frame)
+        return data
+
+    # Start remote connections -> only configuration errors are fatal, unavailable servers are retried by login threads
+    def start(self, login_timeout=10):
+        try:
+            for opc_client in self.opc_clients:
+                opc_client.compilePlans()
+            self.checkScanClasses()
+        except Exception as e:
+            logging.error("Configuration of variables is not valid -> " + str(e))
+            sys.exit(1)
+        # Login in background threads -> wait for the first attempt of every server, but not for a server which does not answer
+        for opc_client in self.opc_clients:
+            opc_client.startReconnect()
+        deadline = time.monotonic() + login_timeout
+        while time.monotonic() < deadline and any(opc_client.login_attempts == 0 for opc_client in self.opc_clients):
+            time.sleep(0.05)
         try:
-            # Login
-            self.opc_client.login()
             self.mqtt_client.login()
             self.ready_flag = True
             logging.info("MQTT and OPC connections have been established")
@@ -444,40 +2585,168 @@ class Control(metaclass=Singleton):
             logging.error("Unable to subscribe to a remote server -> " + str(e))
             sys.exit(1)
 
-    # Launch the main processing loop -> read and send data
+    # Pass data to the publish stage -> drop the oldest data if the queue is full
+    def enqueue(self, data):
+        while True:
+            try:
+                self.queue.put_nowait(data)
+                return
+            except queue.Full:
+                try:
+                    self.releaseFrame(self.queue.get_nowait())
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    # Publish stage -> send data from the queue via MQTT
+    def publish(self):
+        while self.ready_flag:
+            try:
+                data = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self.mqtt_client.sendData(data)
+                # Formatting of the whole data is expensive, do it only for debug
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug("MQTT data have been send -> " + str(data))
+            except Exception as e:
+                logging.error("Unable to send data to a remote server -> " + str(e))
+            self.releaseFrame(data)
+
+    # Get pipeline counters
+    def getStats(self):
+        return {"ticks": self.ticks, "overruns": self.overruns, "missed_ticks": self.missed_ticks,
+                "dropped": self.dropped, "queue_depth": self.queue.qsize()}
+
+    # Launch the main processing loop -> read data on a fixed rate, the publish stage sends them
     def run(self):
         data = {}
+        self.publisher = threading.Thread(target=self.publish, name="publisher", daemon=True)
+        self.publisher.start()
+        if len(self.opc_clients) > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.opc_clients))
+        now = time.monotonic()
+        next_stats = now + self.stats_interval
+        for scan_class in self.scan_classes.values():
+            scan_class.next_tick = now
         try:
             while self.ready_flag:
-                # Read OPC data
-                data = self.opc_client.pollData()
-                # Send them via MQTT
-                self.mqtt_client.sendData(data)
-                logging.debug("MQTT data have been send -> " + str(data))
-                # Sleep before the next poll
-                time.sleep(int(self.poll_interval))
+                # Reload the configuration between two cycles
+                now = time.monotonic()
+                if self.reload_requested or self.configChanged(now):
+                    self.reload_requested = False
+                    self.reload()
+                # Read only scan classes which are due
+                for scan_class in self.scan_classes.values():
+                    scan_class.reschedule(self)
+                now = time.monotonic()
+                due = [scan_class for scan_class in self.scan_classes.values() if scan_class.next_tick <= now]
+                if len(due) == 0:
+                    # Sleep before the next poll -> in short slices, so commands and reloads are applied without waiting for a long interval
+                    time.sleep(min(min(scan_class.next_tick for scan_class in self.scan_classes.values()) - now, 0.5))
+                    continue
+                try:
+                    with self.metrics.time("cycle"):
+                        # Read OPC data
+                        data = self.pollData([scan_class.name for scan_class in due])
+                        # A failed capture does not stop publishing of the cycle -> counted as capture_errors by the stage timer
+                        if self.capture is not None and len(data) > 0:
+                            try:
+                                with self.metrics.time("capture"):
+                                    self.capture.write(data, position=self.mqtt_client.snmp_client.getPosition())
+                            except Exception as e:
+                                logging.error("Unable to write data to the capture -> " + str(e))
+                        # Send them via MQTT
+                        self.enqueue(data)
+                except Exception as e:
+                    # One failed cycle does not stop the acquisition
+                    logging.error("Unable to receive/send data from a remote server -> "+ str(e))
+                self.ticks += 1
+
+                # The next tick is scheduled from the previous one so the rate does not drift
+                now = time.monotonic()
+                for scan_class in due:
+                    interval = scan_class.getInterval(self)
+                    scan_class.next_tick += interval
+                    scan_class.interval = interval
+                    if now >= scan_class.next_tick:
+                        # Overrun -> poll immediately and skip ticks which are late for more than one interval
+                        self.overruns += 1
+                        missed = int((now - scan_class.next_tick) // interval)
+                        if missed > 0:
+                            self.missed_ticks += missed
+                            scan_class.next_tick += missed*interval
+
+                if now >= next_stats:
+                    logging.info("Pipeline statistics -> " + str(self.getStats()))
+                    if self.publish_stats == "True":
+                        self.mqtt_client.sendStats(self.metrics.snapshot())
+                    # Snapshot of registers for a fast restart
+                    for opc_client in self.opc_clients:
+                        opc_client.saveRegisters()
+                    next_stats = now + self.stats_interval
         except Exception as e:
             logging.error("Unable to receive/send data from a remote server -> "+ str(e))
             sys.exit(1)
             
             
-    # Stop all remote connections
+    # Stop all remote connections -> a failed logout does not prevent others
     def stop(self):
         self.ready_flag = False
+        # Logout
+        for opc_client in self.opc_clients:
+            opc_client.stopReconnect()
+            try:
+                if opc_client.connected:
+                    opc_client.logout()
+                else:
+                    opc_client.dropSession()
+                    opc_client.closeHistory()
+                    opc_client.saveRegisters()
+            except Exception as e:
+                logging.error("Unable to logout from a remote server -> " + str(e))
         try:
-            # Logout
-            self.opc_client.logout()
             self.mqtt_client.logout()
-            logging.info("MQTT and OPC connection have been closed")
-
         except Exception as e:
             logging.error("Unable to logout from a remote server -> " + str(e))
-            sys.exit(1)
+        if self.capture is not None:
+            self.capture.close()
+        logging.info("MQTT and OPC connection have been closed")
             
 
+# Replay a capture through the MQTT publish path -> speed 1 is real time, N is N times faster and 0 is as fast as possible
+def replayCapture(filename, mqtt_client, speed=1, original_time=True):
+    capture = Capture(filename)
+    first = None
+    start = time.monotonic()
+    frames = 0
+    records = 0
+    for timestamp, position, data in capture.frames():
+        if first is None:
+            first = timestamp
+        if speed > 0:
+            delay = start + (timestamp - first)/1000/speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        mqtt_client.sendData(data, timestamp if original_time else None, position)
+        frames += 1
+        records += len(data)
+    elapsed = time.monotonic() - start
+    logging.info("Capture replayed -> " + str(frames) + " frames, " + str(records) + " records in " + str(round(elapsed, 3)) + " s")
+    return frames, records, elapsed
+
 if __name__ == "__main__":
+    # Command line -> without arguments the plugin runs as usual, --replay publishes a capture instead
+    parser = argparse.ArgumentParser(description="OPC/UA IOx plugin")
+    parser.add_argument("--config", default="/data/package_config.ini", help="configuration file")
+    parser.add_argument("--replay", help="publish a capture file instead of reading the OPC/UA servers")
+    parser.add_argument("--speed", type=float, default=1, help="replay speed -> 1 is real time, N is N times faster, 0 is as fast as possible")
+    parser.add_argument("--now", action="store_true", help="replay with the current time instead of the captured timestamps")
+    args = parser.parse_args()
+
     # Get configuration object from GUI management location
-    params = Config("/data/package_config.ini")
+    params = Config(args.config)
     # General configuration parameters
     general = params.getGeneral()
     # Get OPC variables to read
@@ -495,13 +2764,63 @@ if __name__ == "__main__":
 
 
     # Create opc, snmp mqtt client objects 
-    snmp_client = SnmpClient(general["gw_ip"],general["community"])
-    opc_client = OpcClient(general["opc_server"],variables,settings,general["persistency"],general["history_length"])
-    mqtt_client = MqttClient(general["mqtt_broker"],general["mqtt_port"],general["topic_name"],snmp_client)
+    snmp_client = SnmpClient(general["gw_ip"],general["community"],general.get("gps_refresh","10"),
+                             general.get("gps_ttl","60"),general.get("gps_fallback","50.0754072,14.4165971"))
+    # Node cache and register snapshots
+    cache_path = general.get("cache_path","/data/cache") if general.get("node_cache","True") == "True" else None
+    opc_client = OpcClient(general["opc_server"],variables,settings,general["persistency"],general["history_length"],general.get("mode","poll"),
+                           general.get("sampling_interval","500"),general.get("queue_size","1"),general.get("subscribe_deadband","0"),
+                           general.get("history_path","/data/history"),cache_path,
+                           general.get("reconnect_delay","1"),general.get("reconnect_max_delay","60"))
+    # Additional OPC/UA servers
+    opc_clients = [opc_client]
+    for name, server in params.getServers().items():
+        opc_clients.append(OpcClient(server["opc_server"],params.getOpcVariables(name),settings,general["persistency"],general["history_length"],
+                                     server["mode"] or "poll",server["sampling_interval"] or "500",server["queue_size"] or "1",
+                                     server["subscribe_deadband"] or "0",general.get("history_path","/data/history"),cache_path,
+                                     general.get("reconnect_delay","1"),general.get("reconnect_max_delay","60")))
+    # Store and forward queue for MQTT outages
+    outbox = None
+    if general.get("store_forward","False") == "True":
+        spool = Spool(general.get("spool_path","/data/spool"),general.get("spool_segment_size","1048576"),general.get("spool_segments","64"))
+        outbox = OutboundQueue(general.get("outbox_memory","1000"),spool)
+    mqtt_client = MqttClient(general["mqtt_broker"],general["mqtt_port"],general["topic_name"],snmp_client,
+                             general.get("publish_mode","tag"),general.get("encoding","str"),outbox,
+                             general.get("replay_rate","100"),general.get("max_inflight","20"),
+                             general.get("reconnect_delay","1"),general.get("reconnect_max_delay","60"))
     logging.debug("OPC and MQTT objects has been created")
 
+    # Replay of a capture -> only the MQTT leg is used
+    if args.replay is not None:
+        mqtt_client.login()
+        mqtt_client.subscribe()
+        deadline = time.monotonic() + 30
+        while not mqtt_client.connected and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if not mqtt_client.connected:
+            logging.error("MQTT broker is not available for the replay")
+            sys.exit(1)
+        frames, records, elapsed = replayCapture(args.replay, mqtt_client, args.speed, not args.now)
+        # Wait until queued messages are written out
+        deadline = time.monotonic() + 30
+        while (mqtt_client.mqtt_client.want_write() or (outbox is not None and len(outbox) > 0)) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        mqtt_client.logout()
+        print("Replayed " + str(frames) + " frames, " + str(records) + " records in " + str(round(elapsed, 3)) + " s")
+        sys.exit(0)
+
+    # Capture of acquisition results
+    capture = None
+    if general.get("capture","False") == "True":
+        capture = Capture(general.get("capture_file","/data/capture/capture.bin"),general.get("capture_max_size","104857600"))
+
     # Create control object and start process
-    ctl = Control(general["polling"],general["polling_change"],opc_client,mqtt_client) 
+    ctl = Control(general["polling"],general["polling_change"],opc_client,mqtt_client,
+                  general.get("publish_queue","10"),general.get("stats_interval","60"),opc_clients,general.get("publish_stats","True"),
+                  params.getScanClasses(),args.config,general.get("config_watch","0"),capture)
+    # Prometheus metrics endpoint
+    if int(general.get("metrics_port","0")) > 0:
+        Metrics().serve(general["metrics_port"])
     logging.debug("Control object has been created")
     ctl.start()
     logging.debug("Control object has started")